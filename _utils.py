@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 from collections import defaultdict, deque
+from contextlib import contextmanager
 import datetime
 import pickle
 import time
@@ -9,8 +10,11 @@ import torch
 import torch.distributed as dist
 
 import errno
+import math
 import os
 
+from network.image_list import ImageList, batch_targets
+
 
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
@@ -36,7 +40,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=dist_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -74,6 +78,11 @@ class SmoothedValue(object):
             value=self.value)
 
 
+def dist_device():
+    """device of the tensors sent between processes: nccl only moves cuda tensors, gloo cpu ones"""
+    return torch.device("cuda") if dist.get_backend() == "nccl" else torch.device("cpu")
+
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)
@@ -87,13 +96,13 @@ def all_gather(data):
         return [data]
 
     # serialized to a Tensor
+    device = dist_device()
     buffer = pickle.dumps(data)
-    storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    tensor = torch.frombuffer(bytearray(buffer), dtype=torch.uint8).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.tensor([tensor.numel()], device="cuda")
-    size_list = [torch.tensor([0], device="cuda") for _ in range(world_size)]
+    local_size = torch.tensor([tensor.numel()], device=device)
+    size_list = [torch.tensor([0], device=device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -103,9 +112,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device="cuda"))
+        tensor_list.append(torch.empty((max_size,), dtype=torch.uint8, device=device))
     if local_size != max_size:
-        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device="cuda")
+        padding = torch.empty(size=(max_size - local_size,), dtype=torch.uint8, device=device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -117,6 +126,15 @@ def all_gather(data):
     return data_list
 
 
+def broadcast_object(obj, src=0):
+    """picklable `obj` of rank `src` on every rank"""
+    if get_world_size() == 1:
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
@@ -238,6 +256,34 @@ def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+class PaddedCollate(object):
+    """
+    Collate a batch into one zero-padded image tensor, H and W rounded up to
+    `size_divisible`, wrapped in an ImageList with the real image sizes, and
+    targets padded by network.image_list.batch_targets. Inside a DataLoader
+    worker the batch tensor is allocated in shared memory directly, so it
+    crosses the worker queue as a single block without another copy.
+    The model transforms accept this form as is.
+    """
+    def __init__(self, size_divisible=32):
+        self.size_divisible = size_divisible
+
+    def __call__(self, batch):
+        images, targets = zip(*batch)
+        image_sizes = [(img.shape[-2], img.shape[-1]) for img in images]
+        stride = self.size_divisible
+        h = int(math.ceil(max(s[0] for s in image_sizes) / stride) * stride)
+        w = int(math.ceil(max(s[1] for s in image_sizes) / stride) * stride)
+        shape = (len(images), images[0].shape[0], h, w)
+        if torch.utils.data.get_worker_info() is not None:
+            batched = torch.zeros(shape, dtype=images[0].dtype).share_memory_()
+        else:
+            batched = images[0].new_zeros(shape)
+        for img, pad_img in zip(images, batched):
+            pad_img[:, : img.shape[-2], : img.shape[-1]].copy_(img)
+        return ImageList(batched, image_sizes), batch_targets(list(targets))
+
+
 def warmup_lr_scheduler(optimizer, warmup_iters, warmup_factor):
 
     def f(x):
@@ -301,6 +347,19 @@ def save_on_master(*args, **kwargs):
         torch.save(*args, **kwargs)
 
 
+@contextmanager
+def main_process_first():
+    """run the block on the main process first, e.g. to build shared caches once, then on the others"""
+    if not is_dist_avail_and_initialized():
+        yield
+        return
+    if not is_main_process():
+        dist.barrier()
+    yield
+    if is_main_process():
+        dist.barrier()
+
+
 def init_distributed_mode(args):
     if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
         args.rank = int(os.environ["RANK"])
@@ -308,7 +367,8 @@ def init_distributed_mode(args):
         args.gpu = int(os.environ['LOCAL_RANK'])
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        args.world_size = int(os.environ['SLURM_NTASKS'])
+        args.gpu = args.rank % torch.cuda.device_count() if torch.cuda.is_available() else 0
     else:
         print('Not using distributed mode')
         args.distributed = False
@@ -316,10 +376,15 @@ def init_distributed_mode(args):
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
-    print('| distributed init (rank {}): {}'.format(
-        args.rank, args.dist_url), flush=True)
+    # nccl between gpus, gloo on cpu nodes
+    if torch.cuda.is_available():
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        args.dist_backend = 'gloo'
+    args.dist_url = getattr(args, 'dist_url', 'env://')
+    print('| distributed init (rank {}, {}): {}'.format(
+        args.rank, args.dist_backend, args.dist_url), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                                          world_size=args.world_size, rank=args.rank)
     torch.distributed.barrier()
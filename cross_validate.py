@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+run the cross-validation folds of train.py concurrently in a process pool
+
+Every fold runs train.main in its own process with an explicit thread budget
+(torch intra-op threads + DataLoader workers). Annotation indexes, path
+manifests and the decoded-image cache are built once up front, so the folds
+only read them. Per-fold best val mAP and test metrics are collected into
+one report.
+
+usage: python cross_validate.py --csv_dir csvfiles --results_dir results [--folds 1 2 3 4 5] \
+           [--max_parallel 5] -- <train.py arguments, optimizer last>
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+
+import pandas as pd
+
+
+def fold_paths(csv_dir, results_dir, fold):
+    return {
+        "train_csv_path": os.path.join(csv_dir, f"fold{fold}", "train.csv"),
+        "val_csv_path": os.path.join(csv_dir, f"fold{fold}", "val.csv"),
+        "logdir": os.path.join(results_dir, f"fold{fold}", "logs"),
+        "save_model_path": os.path.join(results_dir, f"fold{fold}", f"f{fold}.pth"),
+    }
+
+
+def thread_budget(num_cpus, parallel, num_threads=0, num_workers=0):
+    '''split the cpus of one fold into torch threads and DataLoader workers'''
+    per_fold = max(1, num_cpus // parallel)
+    threads = num_threads or max(1, per_fold // 2)
+    workers = num_workers or max(1, per_fold - threads)
+    return threads, workers
+
+
+def prepare(args):
+    '''build everything the folds share before they start, so no two folds write the same file'''
+    from tool.annotation_index import AnnotationIndex
+    from tool.image_cache import build_image_cache
+    from tool.manifest import validate_paths
+    from train import image_cache_dir
+
+    image_list = []
+    for csv_path in args.csv_paths:
+        index = AnnotationIndex.from_csv(csv_path)
+        if args.check_paths == "eager":
+            validate_paths(index.image_list, os.path.join(index.index_dir, "manifest.json"))
+        if args.num_buckets > 0 and csv_path in args.train_csv_paths:
+            index.image_sizes()
+        image_list.extend(index.image_list)
+    if args.image_cache:
+        cache_dir = image_cache_dir(args)
+        n = build_image_cache(image_list, cache_dir, os.cpu_count(), args.resize_policy)
+        print(f"cached {n} new images in {cache_dir}")
+
+
+def run_fold(argv, num_threads, log_path):
+    '''entry point of a fold process'''
+    # before torch is imported in this process
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = str(num_threads)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "w", buffering=1) as log:
+        sys.stdout = sys.stderr = log
+        try:
+            import train
+            args = train.parser.parse_args(argv)
+            return train.main(args)
+        except BaseException:
+            traceback.print_exc()
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="concurrent cross-validation of train.py")
+    parser.add_argument("--csv_dir", type=str, required=True, help="dir holding fold{k}/train.csv and fold{k}/val.csv")
+    parser.add_argument("--results_dir", type=str, required=True, help="fold{k}/ logs, weights and predictions go here")
+    parser.add_argument("--folds", type=int, nargs="+", default=[1, 2, 3, 4, 5])
+    parser.add_argument("--max_parallel", type=int, default=0, help="folds running at once, default all")
+    parser.add_argument("--num_cpus", type=int, default=os.cpu_count(), help="cpus shared by the folds")
+    parser.add_argument("--threads_per_fold", type=int, default=0, help="torch threads per fold, default half its cpus")
+    parser.add_argument("--workers_per_fold", type=int, default=0, help="DataLoader workers per fold, default the rest of its cpus")
+    parser.add_argument("--devices", type=str, nargs="+", default=None,
+                        help="devices the folds are spread over round robin, default train.py's choice")
+    parser.add_argument("train_args", nargs=argparse.REMAINDER, help="arguments passed to train.py")
+    cv_args = parser.parse_args()
+    train_argv = cv_args.train_args[1:] if cv_args.train_args[:1] == ["--"] else cv_args.train_args
+
+    import train
+    parallel = cv_args.max_parallel or len(cv_args.folds)
+    threads, workers = thread_budget(cv_args.num_cpus, parallel, cv_args.threads_per_fold, cv_args.workers_per_fold)
+    print(f"{len(cv_args.folds)} folds, {parallel} at once, {threads} threads + {workers} workers each")
+
+    jobs = {}
+    for i, fold in enumerate(cv_args.folds):
+        paths = fold_paths(cv_args.csv_dir, cv_args.results_dir, fold)
+        fold_argv = ["--fold", str(fold), "--num_threads", str(threads), "--num_workers", str(workers)]
+        for k, v in paths.items():
+            fold_argv += [f"--{k}", v]
+        if cv_args.devices:
+            fold_argv += ["--device", cv_args.devices[i % len(cv_args.devices)]]
+        # per fold options go before the optimizer sub command
+        jobs[fold] = fold_argv + train_argv
+
+    # shared inputs of all folds, parsed as train.py would
+    shared = train.parser.parse_args(jobs[cv_args.folds[0]])
+    shared.train_csv_paths = [fold_paths(cv_args.csv_dir, cv_args.results_dir, f)["train_csv_path"] for f in cv_args.folds]
+    shared.csv_paths = shared.train_csv_paths + \
+        [fold_paths(cv_args.csv_dir, cv_args.results_dir, f)["val_csv_path"] for f in cv_args.folds] + [shared.test_csv_path]
+    prepare(shared)
+
+    start_time = time.time()
+    results = []
+    # spawn: fresh interpreters, safe with cuda and with the thread pools of torch
+    with ProcessPoolExecutor(parallel, mp_context=mp.get_context("spawn")) as pool:
+        futures = {}
+        for fold, argv in jobs.items():
+            log_path = os.path.join(cv_args.results_dir, f"fold{fold}", "train.log")
+            futures[pool.submit(run_fold, argv, threads, log_path)] = fold
+        for future in as_completed(futures):
+            fold = futures[future]
+            try:
+                metrics = future.result()
+                print(f"fold{fold} done: best val mAP {metrics['best_val_mAP']:.4f} at epoch {metrics['best_epoch']}, "
+                      f"test mAP {metrics['test_mAP']:.4f}, test F1 {metrics['test_F1']:.4f}, test FROC {metrics['test_FROC']:.4f}")
+            except Exception as e:
+                print(f"fold{fold} failed: {e!r}, see {cv_args.results_dir}/fold{fold}/train.log")
+                metrics = {"fold": fold}
+            results.append(metrics)
+
+    report = pd.DataFrame(results).sort_values("fold").set_index("fold")
+    summary = report.agg(["mean", "std"]) if len(report.columns) else pd.DataFrame(index=["mean", "std"])
+    print(pd.concat([report, summary]).to_string(float_format="{:.4f}".format))
+    os.makedirs(cv_args.results_dir, exist_ok=True)
+    report.to_csv(os.path.join(cv_args.results_dir, "cv_report.csv"))
+    with open(os.path.join(cv_args.results_dir, "cv_report.json"), "w") as f:
+        json.dump({"folds": report.reset_index().to_dict("records"),
+                   "mean": summary.loc["mean"].to_dict(), "std": summary.loc["std"].to_dict()}, f, indent=2)
+    total_time_str = str(datetime.timedelta(seconds=int(time.time() - start_time)))
+    print('Cross validation time {}'.format(total_time_str))
+
+
+if __name__ == "__main__":
+    main()
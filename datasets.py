@@ -1,82 +1,288 @@
+import io
 import os
+import random
+import numpy as np
 import torch
+import torchvision
 
 from PIL import Image
-import pandas as pd
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
+from tool.annotation_index import AnnotationIndex
+from tool.image_cache import ImageCache
+from tool.manifest import validate_paths
+from tool.shards import ShardIndex
+
+
+def make_target(boxes, idx):
+    '''build the training target of image `idx` from its [N, 4] box array'''
+    # copy the mmap slice, transforms modify boxes in place
+    boxes = torch.from_numpy(np.array(boxes, dtype=np.float32)).reshape(-1, 4)
+    labels = torch.ones(len(boxes), dtype=torch.int64)
+    image_id = torch.tensor([idx])
+    iscrowd = torch.zeros(len(boxes), dtype=torch.int64)
+    area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
+
+    target = {}
+    target["boxes"] = boxes
+    target["labels"] = labels
+    target["image_id"] = image_id
+    target["iscrowd"] = iscrowd
+    target["area"] = area
+    return target
+
+
+def resize_target(target, orig_size, size):
+    '''
+    target of an image stored pre-resized from `orig_size` to `size` (H, W),
+    boxes follow the image and both sizes are kept to map predictions back
+    '''
+    target = dict(target)
+    ratio_h, ratio_w = size[0] / orig_size[0], size[1] / orig_size[1]
+    if "boxes" in target:
+        target["boxes"] = target["boxes"] * torch.tensor([ratio_w, ratio_h, ratio_w, ratio_h])
+    if "area" in target:
+        target["area"] = target["area"] * (ratio_w * ratio_h)
+    target["orig_size"] = torch.tensor(orig_size)
+    target["size"] = torch.tensor(size)
+    return target
 
 
 class TCTDataset(Dataset):
-    ''''''
-    def __init__(self, root, transforms, train = True, csv_name = "train.csv"):
+    '''
+    root: fold csv file, or the dir holding `csv_name`
+    index_dir: where the compiled annotation index of the csv lives,
+               default next to the csv (see tool/annotation_index.py)
+    image_cache: optional decoded-pixel cache dir (see tool/image_cache.py),
+                 images missing from it are decoded from disk as usual. For a
+                 cache with a resize policy the target is resized with the image
+                 and carries "orig_size" and "size", also in eval mode
+    check_paths: "eager" checks every image exists at startup with a thread pool,
+                 remembering the result in a manifest next to the index (see tool/manifest.py),
+                 "lazy" skips the check and a missing image fails when it is first loaded
+    uint8: load images as uint8 [C, H, W] tensors instead of PIL images, the
+           conversion to float and normalization happen in the model transform
+    '''
+    def __init__(self, root, transforms, train = True, csv_name = "train.csv", index_dir = None, image_cache = None,
+                 check_paths = "eager", uint8 = False):
         super().__init__()
         self.root = root
-        annotation = pd.read_csv(os.path.join(self.root,csv_name))
+        csv_path = root if os.path.isfile(root) else os.path.join(self.root, csv_name)
+        self.index = AnnotationIndex.from_csv(csv_path, index_dir)
 
-        self.image_list = list(annotation['image_path'])
+        self.image_list = self.index.image_list
 
-        for path in self.image_list:
-            assert os.path.exists(path),  "not found {} file.".format(path)
+        assert check_paths in ("eager", "lazy"), "check_paths must be eager or lazy"
+        if check_paths == "eager":
+            validate_paths(self.image_list, os.path.join(self.index.index_dir, "manifest.json"))
 
-        self.annotations = list(annotation['annotation'])
+        if isinstance(image_cache, str):
+            image_cache = ImageCache(image_cache)
+        self.image_cache = image_cache
         self.transforms = transforms
         self.train = train
+        self.uint8 = uint8
 
 
     def __len__(self):
         return len(self.image_list)
 
 
-    def __getitem__(self, idx):
-        
+    def load_image(self, idx, crop = None):
+        '''crop: optional (x0, y0, x1, y1) window, only that part is copied out of the image cache'''
         img_path = self.image_list[idx]
+        if self.image_cache is not None and img_path in self.image_cache:
+            pixels = self.image_cache.get(img_path)
+            if crop is not None:
+                x0, y0, x1, y1 = crop
+                pixels = pixels[y0:y1, x0:x1]
+            if self.uint8:
+                return torch.from_numpy(pixels.transpose(2, 0, 1).copy())
+            return Image.fromarray(np.ascontiguousarray(pixels))
+        if self.uint8:
+            data = torchvision.io.read_file(img_path)
+            image = torchvision.io.decode_image(data, mode=torchvision.io.ImageReadMode.RGB)
+            if crop is not None:
+                x0, y0, x1, y1 = crop
+                image = image[:, y0:y1, x0:x1].clone()
+            return image
         image = Image.open(img_path).convert('RGB')
+        if crop is not None:
+            image = image.crop(crop)
+        return image
 
-        annotation = self.annotations[idx]
+
+    def __getitem__(self, idx):
         
-        if type(annotation) != str:
-            annotation = str(annotation)
+        image = self.load_image(idx)
 
         if self.train:        
-            boxes = []
-            labels = []           
-            annotation_list = annotation.split(";")       
-            for anno in annotation_list:
-                label = int(1)
-                x = []
-                y = []
-                anno = anno[2:]  # one box coord str
-                anno = anno.split(" ")
-                for i in range(len(anno)):
-                    if i % 2 == 0:
-                        x.append(float(anno[i]))
-                    else:
-                        y.append(float(anno[i]))
-
-                xmin = min(x)
-                xmax = max(x)
-                ymin = min(y)
-                ymax = max(y)
-                boxes.append([xmin, ymin, xmax, ymax])
-                labels.append(label)
-            
-            # convert anything to torch tensor
-            boxes = torch.as_tensor(boxes, dtype=torch.float32)
-            labels = torch.as_tensor(labels, dtype=torch.int64)
-            image_id = torch.tensor([idx])
-            iscrowd = torch.zeros(len(boxes), dtype=torch.int64)
-            area = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0])
-
-            target = {}
-            target["boxes"] = boxes
-            target["labels"] = labels
-            target["image_id"] = image_id
-            target["iscrowd"] = iscrowd
-            target["area"] = area
+            target = make_target(self.index.boxes(idx), idx)
         else:
             target = {}
 
+        img_path = self.image_list[idx]
+        if self.image_cache is not None and self.image_cache.policy is not None and img_path in self.image_cache:
+            size = tuple(int(s) for s in self.image_cache.shapes[self.image_cache.slots[img_path]][:2])
+            target = resize_target(target, self.image_cache.orig_size(img_path), size)
+
+        image, target = self.transforms(image, target)
+
+        return image, target
+
+
+class TCTCropDataset(TCTDataset):
+    '''
+    Training on fixed-size crops of the large cytology fields instead of
+    whole resized images. A crop is placed at random around a random
+    annotated box, or, with probability `background_rate` (and for images
+    without boxes), at a random position preferring windows without boxes.
+    Boxes are clipped to the crop and dropped if less than `min_visibility`
+    of their area is left inside.
+
+    crop_size: (h, w) or int, clamped to the image size
+    crops_per_image: crops drawn from every image per epoch
+    '''
+    def __init__(self, root, transforms, crop_size = 512, background_rate = 0.1, min_visibility = 0.5,
+                 crops_per_image = 1, **kwargs):
+        super().__init__(root, transforms, train=True, **kwargs)
+        if isinstance(crop_size, int):
+            crop_size = (crop_size, crop_size)
+        self.crop_size = crop_size
+        self.background_rate = background_rate
+        self.min_visibility = min_visibility
+        self.crops_per_image = crops_per_image
+        self.image_sizes = self.index.image_sizes()
+        assert self.image_cache is None or self.image_cache.policy is None, "crops need a full resolution image cache."
+
+
+    def __len__(self):
+        return len(self.image_list) * self.crops_per_image
+
+
+    def sample_crop(self, boxes, h, w):
+        ch, cw = min(self.crop_size[0], h), min(self.crop_size[1], w)
+        if len(boxes) == 0 or random.random() < self.background_rate:
+            for _ in range(10):
+                x0, y0 = random.randint(0, w - cw), random.randint(0, h - ch)
+                overlap = ((boxes[:, 0] < x0 + cw) & (boxes[:, 2] > x0) &
+                           (boxes[:, 1] < y0 + ch) & (boxes[:, 3] > y0))
+                if not overlap.any():
+                    break
+            return (x0, y0, x0 + cw, y0 + ch)
+
+        xmin, ymin, xmax, ymax = boxes[random.randrange(len(boxes))]
+
+        def place(lo, hi, crop, size):
+            # any origin keeping [lo, hi] inside the crop, centred if the box is larger than the crop
+            first = max(0, int(np.ceil(hi)) - crop)
+            last = min(size - crop, int(lo))
+            if first > last:
+                return int(min(max((lo + hi - crop) / 2, 0), size - crop))
+            return random.randint(first, last)
+
+        x0 = place(xmin, xmax, cw, w)
+        y0 = place(ymin, ymax, ch, h)
+        return (x0, y0, x0 + cw, y0 + ch)
+
+
+    def crop_boxes(self, boxes, crop):
+        x0, y0, x1, y1 = crop
+        clipped = boxes - np.array([x0, y0, x0, y0], dtype=boxes.dtype)
+        clipped[:, 0::2] = clipped[:, 0::2].clip(0, x1 - x0)
+        clipped[:, 1::2] = clipped[:, 1::2].clip(0, y1 - y0)
+        area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        clipped_area = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+        keep = (clipped_area > 0) & (clipped_area >= self.min_visibility * area)
+        return clipped[keep]
+
+
+    def __getitem__(self, i):
+        idx = i // self.crops_per_image
+        boxes = np.array(self.index.boxes(idx))
+        h, w = self.image_sizes[idx]
+        crop = self.sample_crop(boxes, int(h), int(w))
+        image = self.load_image(idx, crop)
+        target = make_target(self.crop_boxes(boxes, crop), idx)
+
         image, target = self.transforms(image, target)
 
         return image, target
+
+
+class TCTShardDataset(IterableDataset):
+    '''
+    Streaming counterpart of TCTDataset reading the shards written by
+    tool/shards.py. Each DataLoader worker reads its own subset of shards
+    sequentially and shuffles samples through a buffer of `shuffle_buffer`
+    images; call set_epoch every epoch to reshuffle.
+    Use at least as many shards as workers, extra workers stay idle.
+    uint8: decode to uint8 [C, H, W] tensors instead of PIL images, as TCTDataset
+    '''
+    def __init__(self, shard_dir, transforms, train = True, shuffle = True, shuffle_buffer = 256, seed = 0,
+                 uint8 = False):
+        super().__init__()
+        self.index = ShardIndex(shard_dir)
+        self.image_list = self.index.image_list
+        self.transforms = transforms
+        self.train = train
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.uint8 = uint8
+        self.epoch = 0
+
+
+    def __len__(self):
+        return len(self.image_list)
+
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+    def _decode(self, idx, data):
+        if self.uint8:
+            image = torchvision.io.decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8),
+                                                mode=torchvision.io.ImageReadMode.RGB)
+        else:
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+        if self.train:
+            target = make_target(self.index.boxes(idx), idx)
+        else:
+            target = {}
+        return self.transforms(image, target)
+
+
+    def _records(self, shards):
+        for shard in shards:
+            yield from self.index.read_shard(shard)
+
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+
+        rng = random.Random(self.seed + self.epoch)
+        shards = list(range(self.index.num_shards))
+        if self.shuffle:
+            rng.shuffle(shards)
+        records = self._records(shards[worker_id::num_workers])
+        if not self.shuffle:
+            for idx, data in records:
+                yield self._decode(idx, data)
+            return
+
+        # the buffer holds encoded bytes, images are decoded only when yielded
+        rng = random.Random((self.seed + self.epoch) * 1000 + worker_id)
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], record = record, buffer[i]
+            yield self._decode(*record)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self._decode(*record)
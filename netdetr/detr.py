@@ -5,6 +5,7 @@ DETR model and criterion classes.
 import torch
 from torch import nn
 
+from network.image_list import ImageList
 from .transform import DETRTransform
 from .detr_util import DETRbody, SetCriterion
 
@@ -42,5 +43,8 @@ class DETR(nn.Module):
             loss_dict = self.losses(out, gt)
             return loss_dict
         else:
-            img_sizes = torch.stack([torch.tensor(img.shape[1:]) for img in images],dim=0)
+            if isinstance(images, ImageList):
+                img_sizes = torch.tensor(images.image_sizes)
+            else:
+                img_sizes = torch.stack([torch.tensor(img.shape[1:]) for img in images],dim=0)
             return self.transform.postprocess(out, img_sizes)
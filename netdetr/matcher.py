@@ -6,6 +6,8 @@ import torch
 from scipy.optimize import linear_sum_assignment
 from torch import nn
 
+from network.amp import float32
+
 from .box_ops import box_cxcywh_to_xyxy, generalized_box_iou
 
 
@@ -32,6 +34,7 @@ class HungarianMatcher(nn.Module):
         assert cost_class != 0 or cost_bbox != 0 or cost_giou != 0, "all costs cant be 0"
 
     @torch.no_grad()
+    @float32
     def forward(self, outputs, targets):
         """ Performs the matching
 
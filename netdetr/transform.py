@@ -4,6 +4,9 @@ import torch
 from torch import nn, Tensor
 import torchvision.transforms.functional as F
 
+from network.amp import float32
+from network.transform import normalize_image
+from network.image_list import ImageList, unbatch_targets
 from .box_ops import box_cxcywh_to_xyxy, box_xyxy_to_cxcywh
 
 
@@ -38,19 +41,57 @@ def _max_by_axis(the_list):
     return maxes
 
 
+def get_size_with_aspect_ratio(image_size, size, max_size=None):
+    w, h = image_size
+    if max_size is not None:
+        min_original_size = float(min((w, h)))
+        max_original_size = float(max((w, h)))
+        if max_original_size / min_original_size * size > max_size:
+            size = int(round(max_size * min_original_size / max_original_size))
+
+    if (w <= h and w == size) or (h <= w and h == size):
+        return (h, w)
+
+    if w < h:
+        ow = size
+        oh = int(size * h / w)
+    else:
+        oh = size
+        ow = int(size * w / h)
+
+    return (oh, ow)
+
+
+def get_size(image_size, size, max_size=None):
+    # size can be min_size (scalar) or (w, h) tuple
+    if isinstance(size, (list, tuple)):
+        return size[::-1]
+    else:
+        return get_size_with_aspect_ratio(image_size, size, max_size)
+
+
 class DETRTransform(nn.Module):
     def __init__(self, 
                  min_size = 800, 
                  max_size = 1333,
                  image_mean = [0.485, 0.456, 0.406], 
-                 image_std = [0.229, 0.224, 0.225]):
+                 image_std = [0.229, 0.224, 0.225],
+                 size_divisible = 1):
         super(DETRTransform, self).__init__()
         self.min_size = min_size
         self.max_size = max_size
         self.image_mean = image_mean
         self.image_std = image_std
+        # pad batches up to a multiple of this, bounds the batch shapes (network.compile)
+        self.size_divisible = size_divisible
 
     def forward(self, images, targets):
+        if isinstance(targets, dict):
+            targets = unbatch_targets(targets)
+        if isinstance(images, ImageList):
+            if all(tuple(get_size(s[::-1], self.min_size, self.max_size)) == tuple(s) for s in images.image_sizes):
+                return self.forward_batched(images, targets)
+            images = images.unbatch()
         images = [img for img in images]
         if targets is not None:
             targets = [{k: v for k,v in t.items()} for t in targets]
@@ -60,9 +101,13 @@ class DETRTransform(nn.Module):
 
             if image.dim() != 3:
                 raise ValueError(f"images is expected to be a list of 3d tensors of shape [C, H, W], got {image.shape}")
+            is_uint8 = image.dtype == torch.uint8
+            if is_uint8:
+                # convert and normalize uint8 in one pass before resizing
+                image = normalize_image(image, self.image_mean, self.image_std)
             image, target_index = self.resize(image, target_index, self.min_size, self.max_size)
             # note that here detr normalize boxes to cxcywh and within [0, 1] by /wh
-            image, target_index = self.normalize(image, target_index)
+            image, target_index = self.normalize(image, target_index, normalize_pixels=not is_uint8)
             images[i] = image
             if targets is not None and target_index is not None:
                 targets[i] = target_index
@@ -70,8 +115,31 @@ class DETRTransform(nn.Module):
         out_images = self.nested_tensor_from_tensor_list(images)
         return out_images, targets
             
-    def normalize(self, image, target):
-        image = F.normalize(image, mean=self.image_mean, std=self.image_std)
+    def forward_batched(self, images, targets):
+        """pre-batched ImageList whose images need no resizing, normalized as a whole without per-image copies"""
+        tensor = normalize_image(images.tensors, self.image_mean, self.image_std)
+        b, _, h, w = tensor.shape
+        mask = torch.ones((b, h, w), dtype=torch.bool, device=tensor.device)
+        for i, (img_h, img_w) in enumerate(images.image_sizes):
+            tensor[i, :, img_h:, :] = 0
+            tensor[i, :, :, img_w:] = 0
+            mask[i, :img_h, :img_w] = False
+        if targets is not None:
+            out_targets = []
+            for (img_h, img_w), target in zip(images.image_sizes, targets):
+                target = target.copy()
+                target["size"] = torch.tensor([img_h, img_w])
+                # boxes to cxcywh within [0, 1], as in normalize
+                if "boxes" in target:
+                    boxes = box_xyxy_to_cxcywh(target["boxes"])
+                    target["boxes"] = boxes / torch.tensor([img_w, img_h, img_w, img_h], dtype=torch.float32, device=boxes.device)
+                out_targets.append(target)
+            targets = out_targets
+        return NestedTensor(tensor, mask), targets
+
+    def normalize(self, image, target, normalize_pixels=True):
+        if normalize_pixels:
+            image = F.normalize(image, mean=self.image_mean, std=self.image_std)
         if target is None:
             return image, None
         target = target.copy()
@@ -89,6 +157,9 @@ class DETRTransform(nn.Module):
 
             # TODO make it support different-sized images
             max_size = _max_by_axis([list(img.shape) for img in tensor_list])
+            stride = self.size_divisible
+            max_size[1] = (max_size[1] + stride - 1) // stride * stride
+            max_size[2] = (max_size[2] + stride - 1) // stride * stride
             # min_size = tuple(min(s) for s in zip(*[img.shape for img in tensor_list]))
             batch_shape = [len(tensor_list)] + max_size
             b, c, h, w = batch_shape
@@ -104,42 +175,20 @@ class DETRTransform(nn.Module):
         return NestedTensor(tensor, mask)
 
     def resize(self, image, target, size, max_size=None):
-        # size can be min_size (scalar) or (w, h) tuple
-
-        def get_size_with_aspect_ratio(image_size, size, max_size=None):
-            w, h = image_size
-            if max_size is not None:
-                min_original_size = float(min((w, h)))
-                max_original_size = float(max((w, h)))
-                if max_original_size / min_original_size * size > max_size:
-                    size = int(round(max_size * min_original_size / max_original_size))
-
-            if (w <= h and w == size) or (h <= w and h == size):
-                return (h, w)
-
-            if w < h:
-                ow = size
-                oh = int(size * h / w)
-            else:
-                oh = size
-                ow = int(size * w / h)
-
-            return (oh, ow)
-
-        def get_size(image_size, size, max_size=None):
-            if isinstance(size, (list, tuple)):
-                return size[::-1]
-            else:
-                return get_size_with_aspect_ratio(image_size, size, max_size)
-
-        size = get_size(image.shape[1:], size, max_size)
-        rescaled_image = F.resize(image, size)
+        # size can be min_size (scalar) or (w, h) tuple, get_size takes the image size as (w, h)
+        size = get_size(image.shape[1:][::-1], size, max_size)
+        if tuple(size) == tuple(image.shape[1:]):
+            # already at the target size, e.g. from a pre-resized image cache
+            rescaled_image = image
+        else:
+            rescaled_image = F.resize(image, size)
 
         if target is None:
             return rescaled_image, None
 
         ratios = tuple(float(s) / float(s_orig) for s, s_orig in zip(rescaled_image.shape[1:], image.shape[1:]))
-        ratio_width, ratio_height = ratios
+        # shape[1:] is (h, w)
+        ratio_height, ratio_width = ratios
 
         target = target.copy()
         if "boxes" in target:
@@ -161,6 +210,7 @@ class DETRTransform(nn.Module):
 
         return rescaled_image, target 
 
+    @float32
     def postprocess(self, outputs, img_sizes):
         """ Perform the computation
         Parameters:
@@ -7,7 +7,9 @@ from .pooling import MultiScaleRoIAlign
 import sys
 sys.path.append('..')
 from .sparse_rcnn_loss import BoxCoder, SparseRCNNLoss
+from network.amp import float32
 from network.transform import GeneralizedRCNNTransform
+from network.image_list import ImageList, unbatch_targets
 from .common import FrozenBatchNorm2d
 
 
@@ -294,11 +296,17 @@ class SparseRCNN(nn.Module):
 
     def forward(self, images, targets=None):
 
+        if isinstance(targets, dict):
+            # padded targets from _utils.PaddedCollate
+            targets = unbatch_targets(targets)
         original_image_sizes = torch.jit.annotate(List[Tuple[int, int]], [])
-        for img in images:
-            val = img.shape[-2:]
-            assert len(val) == 2  # 防止输入的是个一维向量
-            original_image_sizes.append((val[0], val[1]))
+        if isinstance(images, ImageList):
+            original_image_sizes = list(images.image_sizes)
+        else:
+            for img in images:
+                val = img.shape[-2:]
+                assert len(val) == 2  # 防止输入的是个一维向量
+                original_image_sizes.append((val[0], val[1]))
         
         # resize图片与标记,并返回为tensor格式
         images,targets = self.transform(images,targets)
@@ -328,12 +336,14 @@ class SparseRCNN(nn.Module):
         else:
             cls_predict = cls_predicts[-1]
             box_predict = box_predicts[-1]
-            predicts = self.post_process(cls_predict, box_predict, shapes)
-            ret['boxes'] = resize_boxes(predicts[0][:,0:4], shapes[0], original_image_sizes[0])  # 将bboxes缩放回原图像尺度上
-            ret['scores'] = predicts[0][:,4]
-            ret['labels'] = predicts[0][:,5].int()
+            # 每张图一个结果, 框裁剪到图像缩放后(未padding)的尺寸内
+            predicts = self.post_process(cls_predict, box_predict, images.image_sizes)
+            result = [{'boxes': p[:, 0:4], 'scores': p[:, 4], 'labels': p[:, 5].int()} for p in predicts]
+            # 将bboxes缩放回原图像尺度上
+            return self.transform.postprocess(result, images.image_sizes, original_image_sizes)
         return ret
 
+    @float32
     def post_process(self, cls_predict, box_predict, shapes):
         assert len(cls_predict) == len(box_predict)
         scores = cls_predict.sigmoid()
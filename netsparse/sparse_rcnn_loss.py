@@ -2,6 +2,7 @@ import torch
 from .commons import IOULoss, BoxSimilarity, focal_loss
 from scipy.optimize import linear_sum_assignment
 from .model_utils import reduce_sum, get_gpu_num_solo
+from network.amp import float32
 
 
 class BoxCoder(object):
@@ -58,6 +59,7 @@ class HungarianMatcher(object):
         self.similarity = BoxSimilarity(iou_type="giou")
 
     @torch.no_grad()
+    @float32
     def __call__(self, predicts_cls, predicts_box, gt_boxes, gt_labels, shape_norm):
         """
         :param predicts_box: [bs,proposal,4]
@@ -119,6 +121,7 @@ class SparseRCNNLoss(object):
             l1_cost=l1_cost
         )
 
+    @float32
     def __call__(self, cls_predicts, reg_predicts, targets, shape):
         h, w = shape
         shape_norm = torch.tensor([w, h, w, h], device=cls_predicts.device)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+helpers for mixed precision training (torch.autocast, bf16 on cpu / fp16 on cuda)
+"""
+import functools
+
+import torch
+
+
+def autocast_enabled() -> bool:
+    try:
+        return torch.is_autocast_enabled("cpu") or torch.is_autocast_enabled("cuda")
+    except TypeError:
+        # torch < 2.4 has no device argument
+        return torch.is_autocast_cpu_enabled() or torch.is_autocast_enabled()
+
+
+def autocast_dtype(device: torch.device) -> torch.dtype:
+    """bf16 on cpu, fp16 on cuda"""
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
+def grad_scaler(device: torch.device, enabled: bool = True):
+    """fp16 gradients need loss scaling, bf16 has the fp32 exponent range and does not: None off cuda"""
+    if not enabled or device.type != "cuda":
+        return None
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda")
+    # torch < 2.3
+    return torch.cuda.amp.GradScaler()
+
+
+def _to_float32(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.float() if obj.is_floating_point() and obj.dtype != torch.float32 else obj
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_float32(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: _to_float32(v) for k, v in obj.items()}
+    return obj
+
+
+def float32(fn):
+    """
+    Run `fn` in fp32 under autocast: autocast is disabled inside and its
+    floating point tensor arguments (also inside lists / dicts) are cast to
+    fp32. Used for box decoding, losses and matching costs, which lose too
+    much in bf16 / fp16. Without autocast `fn` is called as is.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not autocast_enabled():
+            return fn(*args, **kwargs)
+        args, kwargs = _to_float32(args), _to_float32(kwargs)
+        with torch.autocast("cpu", enabled=False):
+            if not torch.cuda.is_available():
+                return fn(*args, **kwargs)
+            with torch.autocast("cuda", enabled=False):
+                return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+torch.compile of the detectors.
+
+Only the static shape parts of a model are compiled, each on its own:
+backbone + FPN, the dense heads, the RoI box heads, the YOLO / DETR bodies.
+The transforms, anchor generation, target matching, losses and postprocess
+(python loops, data dependent shapes, NMS) keep running eagerly, so they
+can not break or re-trigger the compiled graphs.
+
+To bound recompiles the batch padding is bucketed: images are padded up to a
+multiple of `size_divisible` (128 by default) instead of 32, so only a few
+batch shapes reach the compiled backbones. SSD and YOLO resize to a fixed
+input size and need no bucketing.
+"""
+import json
+from collections import Counter, OrderedDict
+
+import torch
+
+
+# model class name -> (submodule, dynamic) to compile. A ModuleList compiles
+# every member. dynamic=None lets dynamo mark the changing dims dynamic, used
+# for the RoI heads whose number of proposals varies per batch.
+COMPILE_TARGETS = {
+    "FasterRCNN": (("backbone", False), ("rpn.head", False),
+                   ("roi_heads.box_head", None), ("roi_heads.box_predictor", None)),
+    "CascadeRCNN": (("backbone", False), ("rpn.head", False),
+                    ("roi_heads.box_head", None), ("roi_heads.box_predictor", None),
+                    ("roi_heads.sec_box_head", None), ("roi_heads.sec_box_predictor", None),
+                    ("roi_heads.thr_box_head", None), ("roi_heads.thr_box_predictor", None)),
+    "RetinaNet": (("backbone", False), ("head", False)),
+    "FCOS": (("backbone", False), ("head", False)),
+    "SSD": (("backbone", False), ("head", False)),
+    "SparseRCNN": (("backbones", False), ("head.heads", False)),
+    "YOLOv3": (("model", False),),
+    "YOLOv7": (("model", False),),
+    "DETR": (("model", False),),
+}
+
+
+def _torch_version():
+    return tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+
+
+def compile_targets(model):
+    """[(name, module, dynamic)] of the parts of `model` that get compiled"""
+    name = model.__class__.__name__
+    assert name in COMPILE_TARGETS, "not found compile targets of {}.".format(name)
+    targets = []
+    for path, dynamic in COMPILE_TARGETS[name]:
+        module = model
+        for attr in path.split("."):
+            module = getattr(module, attr)
+        if isinstance(module, torch.nn.ModuleList):
+            targets.extend(("{}.{}".format(path, i), m, dynamic) for i, m in enumerate(module))
+        else:
+            targets.append((path, module, dynamic))
+    return targets
+
+
+def _eager_forward(module):
+    # the class forward, also after compile_model replaced the instance one
+    return type(module).forward.__get__(module, type(module))
+
+
+def compile_model(model, size_divisible=128, **kwargs):
+    """
+    Compile the static shape parts of `model` in place and bucket its batch
+    padding to `size_divisible`. Only the forward of the submodules is
+    replaced, state_dict keys stay the same. kwargs go to torch.compile.
+    Returns the compiled submodule names.
+    """
+    names = []
+    for name, module, dynamic in compile_targets(model):
+        module.forward = torch.compile(_eager_forward(module), dynamic=dynamic, **kwargs)
+        names.append(name)
+    transform = getattr(model, "transform", None)
+    if hasattr(transform, "size_divisible") and getattr(transform, "fixed_size", None) is None:
+        transform.size_divisible = max(transform.size_divisible, size_divisible)
+    return names
+
+
+def _explain(fn, *args, **kwargs):
+    """(graph count, graph break count, break reasons) of tracing fn(*args, **kwargs) with dynamo"""
+    import torch._dynamo as dynamo
+    if _torch_version() >= (2, 1):
+        out = dynamo.explain(fn)(*args, **kwargs)
+        graphs, breaks, reasons = out.graph_count, out.graph_break_count, out.break_reasons
+    else:
+        # torch 2.0 runs fn right away and returns a tuple
+        _, _, graphs, _, reasons, _ = dynamo.explain(fn, *args, **kwargs)
+        graphs, breaks = len(graphs), len(reasons)
+    dynamo.reset()
+    # first line of every reason, the rest is the user stack
+    return graphs, breaks, [str(r.reason).strip().split("\n")[0] for r in reasons]
+
+
+def graph_break_report(model, images, targets=None):
+    """
+    Trace `model` on one batch with torch._dynamo.explain and count the graph
+    breaks of the whole forward and of every compile target. The inputs of
+    the targets are captured by forward pre hooks while the batch runs
+    eagerly. Runs in train mode with `targets`, else in eval mode.
+    """
+    captured = OrderedDict()
+    hooks = []
+    targets_list = compile_targets(model)
+    for name, module, _ in targets_list:
+        def hook(m, args, kwargs, name=name):
+            captured.setdefault(name, (args, kwargs))
+        hooks.append(module.register_forward_pre_hook(hook, with_kwargs=True))
+
+    report = OrderedDict(model=model.__class__.__name__, parts=OrderedDict())
+    with torch.no_grad():
+        model(images, targets)
+        for h in hooks:
+            h.remove()
+        for name, module, _ in targets_list:
+            if name not in captured:
+                continue
+            args, kwargs = captured[name]
+            graphs, breaks, reasons = _explain(_eager_forward(module), *args, **kwargs)
+            report["parts"][name] = {"graphs": graphs, "graph_breaks": breaks,
+                                     "reasons": dict(Counter(reasons))}
+        try:
+            graphs, breaks, reasons = _explain(_eager_forward(model), images, targets)
+            report["model_forward"] = {"graphs": graphs, "graph_breaks": breaks,
+                                       "reasons": dict(Counter(reasons))}
+        except Exception as e:
+            report["model_forward"] = {"error": "{}: {}".format(type(e).__name__, str(e).split("\n")[0])}
+    return report
+
+
+def print_report(report, json_path=None):
+    print(f"graph breaks of {report['model']}:")
+    for name, part in list(report["parts"].items()) + [("(whole forward)", report["model_forward"])]:
+        if "error" in part:
+            print(f"    {name:<32s} explain failed, {part['error']}")
+            continue
+        print(f"    {name:<32s} {part['graphs']} graphs, {part['graph_breaks']} breaks")
+        for reason, count in part["reasons"].items():
+            print(f"        {count}x {reason}")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
@@ -9,6 +9,8 @@ from torch import nn, Tensor
 from torch.nn import functional as F
 from torchvision.ops import complete_box_iou_loss, distance_box_iou_loss, FrozenBatchNorm2d, generalized_box_iou_loss
 
+from .amp import float32
+
 
 class BalancedPositiveNegativeSampler(object):
     """
@@ -219,6 +221,7 @@ class BoxCoder(object):
 
         return pred_boxes
 
+    @float32
     def decode_single(self, rel_codes, boxes):
         """
         From a set of original boxes and encoded relative box offsets,
@@ -313,6 +316,7 @@ class BoxLinearCoder:
             targets = targets / reference_boxes_size
         return targets
 
+    @float32
     def decode(self, rel_codes: Tensor, boxes: Tensor) -> Tensor:
 
         """
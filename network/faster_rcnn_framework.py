@@ -11,6 +11,7 @@ from torchvision.ops import MultiScaleRoIAlign
 
 from .roi_head import CascadeRoIHeads,RoIHeads
 from .transform import GeneralizedRCNNTransform
+from .image_list import ImageList, unbatch_targets
 from .rpn_function import AnchorsGenerator, RPNHead, RegionProposalNetwork
 
 
@@ -60,6 +61,9 @@ class FasterRCNNBase(nn.Module):
         """
         if self.training and targets is None:
             raise ValueError("In training mode, targets should be passed")
+        if isinstance(targets, dict):
+            # padded targets from _utils.PaddedCollate
+            targets = unbatch_targets(targets)
 
         if self.training:
             assert targets is not None
@@ -75,10 +79,13 @@ class FasterRCNNBase(nn.Module):
                                      "Tensor, got {:}.".format(type(boxes)))
 
         original_image_sizes = torch.jit.annotate(List[Tuple[int, int]], [])
-        for img in images:
-            val = img.shape[-2:]
-            assert len(val) == 2  
-            original_image_sizes.append((val[0], val[1]))
+        if isinstance(images, ImageList):
+            original_image_sizes = list(images.image_sizes)
+        else:
+            for img in images:
+                val = img.shape[-2:]
+                assert len(val) == 2  
+                original_image_sizes.append((val[0], val[1]))
         # original_image_sizes = [img.shape[-2:] for img in images]
 
         images, targets = self.transform(images, targets)  
@@ -8,12 +8,14 @@ import torch
 from torch import nn, Tensor
 
 from . import det_utils
+from .amp import float32
 from . import boxes as box_ops
 from .giou_loss import generalized_box_iou_loss
 from .focalloss import sigmoid_focal_loss
 
 from .rpn_function import AnchorsGenerator
 from .transform import GeneralizedRCNNTransform
+from .image_list import ImageList, unbatch_targets
 
 
 class FCOSHead(nn.Module):
@@ -469,6 +471,7 @@ class FCOS(nn.Module):
 
         return self.head.compute_loss(targets, head_outputs, anchors, matched_idxs)
 
+    @float32
     def postprocess_detections(
         self, head_outputs: Dict[str, List[Tensor]], anchors: List[List[Tensor]], image_shapes: List[Tuple[int, int]]
     ) -> List[Dict[str, Tensor]]:
@@ -554,6 +557,9 @@ class FCOS(nn.Module):
                 During testing, it returns list[BoxList] contains additional fields
                 like `scores`, `labels` and `mask` (for Mask R-CNN models).
         """
+        if isinstance(targets, dict):
+            # padded targets from _utils.PaddedCollate
+            targets = unbatch_targets(targets)
         if self.training:
 
             if targets is None:
@@ -568,13 +574,16 @@ class FCOS(nn.Module):
                     )
 
         original_image_sizes: List[Tuple[int, int]] = []
-        for img in images:
-            val = img.shape[-2:]
-            torch._assert(
-                len(val) == 2,
-                f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
-            )
-            original_image_sizes.append((val[0], val[1]))
+        if isinstance(images, ImageList):
+            original_image_sizes = list(images.image_sizes)
+        else:
+            for img in images:
+                val = img.shape[-2:]
+                torch._assert(
+                    len(val) == 2,
+                    f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
+                )
+                original_image_sizes.append((val[0], val[1]))
 
         # transform the input
         images, targets = self.transform(images, targets)
@@ -4,6 +4,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .amp import float32
+
 
 class BCEFocalLoss(nn.Module):
     '''二分类focalloss'''
@@ -108,6 +110,7 @@ class FocalLoss(nn.Module):
         return loss
 
 
+@float32
 def sigmoid_focal_loss(
     inputs: torch.Tensor,
     targets: torch.Tensor,
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # coding=utf-8
-from typing import List, Tuple
+from typing import List, Tuple, Dict
+import torch
 from torch import Tensor
 
 
+# fields holding one value per image, everything else is one row per box
+IMAGE_FIELDS = ("image_id", "orig_size", "size")
+
+
 class ImageList(object):
     """
     Structure that holds a list of images (of possibly
@@ -29,3 +34,46 @@ class ImageList(object):
         cast_tensor = self.tensors.to(device)
         return ImageList(cast_tensor, self.image_sizes)
 
+    def unbatch(self):
+        # type: () -> List[Tensor]
+        """views of the images without their padding"""
+        return [img[:, :h, :w] for img, (h, w) in zip(self.tensors, self.image_sizes)]
+
+
+def batch_targets(targets):
+    # type: (List[Dict[str, Tensor]]) -> Dict[str, Tensor]
+    """
+    将一个batch的targets打包成padding后的tensor
+    per-box fields ([N, ...], e.g. boxes, labels, area) are padded with zeros to
+    [B, M, ...] where M is the max number of boxes in the batch, per-image
+    fields (IMAGE_FIELDS, e.g. image_id) are stacked, "num_boxes" [B] holds the real counts.
+    """
+    if len(targets) == 0 or len(targets[0]) == 0:
+        return {}
+    num_boxes = [len(t["boxes"]) if "boxes" in t else 0 for t in targets]
+    max_boxes = max(num_boxes)
+    batched = {"num_boxes": torch.as_tensor(num_boxes, dtype=torch.int64)}
+    for k, v in targets[0].items():
+        if k in IMAGE_FIELDS:
+            batched[k] = torch.stack([t[k] for t in targets])
+            continue
+        out = v.new_zeros((len(targets), max_boxes) + tuple(v.shape[1:]))
+        for i, t in enumerate(targets):
+            out[i, : num_boxes[i]].copy_(t[k])
+        batched[k] = out
+    return batched
+
+
+def unbatch_targets(targets):
+    # type: (Dict[str, Tensor]) -> List[Dict[str, Tensor]]
+    """inverse of batch_targets, the per-image tensors are views into the padded ones"""
+    num_boxes = targets["num_boxes"].tolist()
+    out: List[Dict[str, Tensor]] = []
+    for i, n in enumerate(num_boxes):
+        t: Dict[str, Tensor] = {}
+        for k, v in targets.items():
+            if k == "num_boxes":
+                continue
+            t[k] = v[i] if k in IMAGE_FIELDS else v[i, :n]
+        out.append(t)
+    return out
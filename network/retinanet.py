@@ -12,8 +12,10 @@ from . import misc as misc_nn_ops
 from .focalloss import sigmoid_focal_loss
 
 from . import det_utils
+from .amp import float32
 from .rpn_function import AnchorsGenerator
 from .transform import GeneralizedRCNNTransform
+from .image_list import ImageList, unbatch_targets
 
 
 def _sum(x: List[Tensor]) -> Tensor:
@@ -486,6 +488,7 @@ class RetinaNet(nn.Module):
 
         return self.head.compute_loss(targets, head_outputs, anchors, matched_idxs)
 
+    @float32
     def postprocess_detections(self, head_outputs, anchors, image_shapes):
         # type: (Dict[str, List[Tensor]], List[List[Tensor]], List[Tuple[int, int]]) -> List[Dict[str, Tensor]]
         class_logits = head_outputs["cls_logits"]
@@ -564,6 +567,9 @@ class RetinaNet(nn.Module):
                 like `scores`, `labels` and `mask` (for Mask R-CNN models).
 
         """
+        if isinstance(targets, dict):
+            # padded targets from _utils.PaddedCollate
+            targets = unbatch_targets(targets)
         if self.training:
             if targets is None:
                 torch._assert(False, "targets should not be none when in training mode")
@@ -578,13 +584,16 @@ class RetinaNet(nn.Module):
 
         # get the original image sizes
         original_image_sizes: List[Tuple[int, int]] = []
-        for img in images:
-            val = img.shape[-2:]
-            torch._assert(
-                len(val) == 2,
-                f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
-            )
-            original_image_sizes.append((val[0], val[1]))
+        if isinstance(images, ImageList):
+            original_image_sizes = list(images.image_sizes)
+        else:
+            for img in images:
+                val = img.shape[-2:]
+                torch._assert(
+                    len(val) == 2,
+                    f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
+                )
+                original_image_sizes.append((val[0], val[1]))
 
         # transform the input
         images, targets = self.transform(images, targets)
@@ -6,11 +6,13 @@ import torch
 from torch import Tensor
 import torch.nn.functional as F
 
+from .amp import float32
 from .focalloss import CEFocalLoss,FocalLoss
 from . import det_utils
 from . import boxes as box_ops
 
 
+@float32
 def fastrcnn_loss(class_logits, box_regression, labels, regression_targets):
     # type: (Tensor, Tensor, List[Tensor], List[Tensor]) -> Tuple[Tensor, Tensor]
     """
@@ -283,6 +285,7 @@ class RoIHeads(torch.nn.Module):
         # List[tensor(512,4),...]  List[tensor(512),...]  List[tensor(512,4),...]长度为2
         return proposals, labels, regression_targets
 
+    @float32
     def postprocess_detections(self,
                                class_logits,    # type: Tensor
                                box_regression,  # type: Tensor
@@ -693,6 +696,7 @@ class CascadeRoIHeads(torch.nn.Module):
         return proposals, labels, regression_targets
 
 
+    @float32
     def postprocess_detections(self,
                                class_logits,    # type: Tensor
                                box_regression,  # type: Tensor
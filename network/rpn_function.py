@@ -8,6 +8,7 @@ from torch.nn import functional as F
 import torchvision
 
 from . import det_utils
+from .amp import float32
 from . import boxes as box_ops
 from .image_list import ImageList
 
@@ -505,6 +506,7 @@ class RegionProposalNetwork(torch.nn.Module):
             offset += num_anchors
         return torch.cat(r, dim=1)
 
+    @float32
     def filter_proposals(self, proposals, objectness, image_shapes, num_anchors_per_level):
         # type: (Tensor, Tensor, List[Tuple[int, int]], List[int]) -> Tuple[List[Tensor], List[Tensor]]
         """
@@ -3,7 +3,7 @@ from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple
 import math
 
-from .image_list import ImageList
+from .image_list import ImageList, unbatch_targets
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
@@ -12,6 +12,7 @@ from . import boxes as box_ops
 from .layergetter import SwinLayerGetter,IntermediateLayerGetter
 from torchvision import models
 from . import det_utils
+from .amp import float32
 from .transform import GeneralizedRCNNTransform
 
 
@@ -432,6 +433,9 @@ class SSD(nn.Module):
     def forward(
         self, images: List[Tensor], targets: Optional[List[Dict[str, Tensor]]] = None
     ) -> Tuple[Dict[str, Tensor], List[Dict[str, Tensor]]]:
+        if isinstance(targets, dict):
+            # padded targets from _utils.PaddedCollate
+            targets = unbatch_targets(targets)
         if self.training:
             if targets is None:
                 torch._assert(False, "targets should not be none when in training mode")
@@ -448,13 +452,16 @@ class SSD(nn.Module):
 
         # get the original image sizes
         original_image_sizes: List[Tuple[int, int]] = []
-        for img in images:
-            val = img.shape[-2:]
-            torch._assert(
-                len(val) == 2,
-                f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
-            )
-            original_image_sizes.append((val[0], val[1]))
+        if isinstance(images, ImageList):
+            original_image_sizes = list(images.image_sizes)
+        else:
+            for img in images:
+                val = img.shape[-2:]
+                torch._assert(
+                    len(val) == 2,
+                    f"expecting the last two dimensions of the Tensor to be H and W instead got {img.shape[-2:]}",
+                )
+                original_image_sizes.append((val[0], val[1]))
 
         # transform the input
         images, targets = self.transform(images, targets)
@@ -517,6 +524,7 @@ class SSD(nn.Module):
             return losses, detections
         return self.eager_outputs(losses, detections)
 
+    @float32
     def postprocess_detections(
         self, head_outputs: Dict[str, Tensor], image_anchors: List[Tensor], image_shapes: List[Tuple[int, int]]
     ) -> List[Dict[str, Tensor]]:
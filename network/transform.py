@@ -7,7 +7,7 @@ import torch
 import torchvision
 from torch import nn, Tensor
 
-from .image_list import ImageList
+from .image_list import ImageList, unbatch_targets
 
 
 def _resize_image(image, self_min_size, self_max_size):
@@ -247,6 +247,27 @@ def resize_boxes(boxes, original_size, new_size):
 #         return image_list, targets
 
 
+def normalize_image(image: Tensor, image_mean: List[float], image_std: List[float]) -> Tensor:
+    """
+    Mean/std normalization of a [C, H, W] image or a [B, C, H, W] batch.
+    float inputs are expected in [0, 1]; uint8 inputs are converted and
+    normalized in one pass, the /255 being folded into mean and std.
+    """
+    if image.dtype == torch.uint8:
+        mean = torch.as_tensor(image_mean, dtype=torch.float32, device=image.device) * 255.0
+        std = torch.as_tensor(image_std, dtype=torch.float32, device=image.device) * 255.0
+        return image.to(torch.float32).sub_(mean[:, None, None]).div_(std[:, None, None])
+    if not image.is_floating_point():
+        raise TypeError(
+            f"Expected input images to be of floating type (in range [0, 1]) or uint8, "
+            f"but found type {image.dtype} instead"
+        )
+    dtype, device = image.dtype, image.device
+    mean = torch.as_tensor(image_mean, dtype=dtype, device=device)
+    std = torch.as_tensor(image_std, dtype=dtype, device=device)
+    return (image - mean[:, None, None]) / std[:, None, None]
+
+
 @torch.jit.unused
 def _get_shape_onnx(image: Tensor) -> Tensor:
     from torch.onnx import operators
@@ -321,6 +342,17 @@ def _resize_image_and_masks(
     return image, target
 
 
+def _resized_size(
+    h: int, w: int, self_min_size: int, self_max_size: int, fixed_size: Optional[Tuple[int, int]] = None
+) -> Tuple[int, int]:
+    """output size of _resize_image_and_masks for an [h, w] image"""
+    if fixed_size is not None:
+        return (fixed_size[1], fixed_size[0])
+    scale_factor = min(self_min_size / min(h, w), self_max_size / max(h, w))
+    # interpolate with recompute_scale_factor floors the scaled size
+    return (int(math.floor(h * scale_factor)), int(math.floor(w * scale_factor)))
+
+
 class GeneralizedRCNNTransform(nn.Module):
     """
     Performs input / target transformation before feeding the data to a GeneralizedRCNN
@@ -331,6 +363,9 @@ class GeneralizedRCNNTransform(nn.Module):
         - input / target resizing to match min_size / max_size
 
     It returns a ImageList for the inputs, and a List[Dict[Tensor]] for the targets
+
+    Images can also come pre-batched as an ImageList (see _utils.PaddedCollate),
+    if no image needs resizing the batch is normalized as a whole and used in place.
     """
 
     def __init__(
@@ -357,6 +392,12 @@ class GeneralizedRCNNTransform(nn.Module):
     def forward(
         self, images: List[Tensor], targets: Optional[List[Dict[str, Tensor]]] = None
     ) -> Tuple[ImageList, Optional[List[Dict[str, Tensor]]]]:
+        if isinstance(targets, dict):
+            targets = unbatch_targets(targets)
+        if isinstance(images, ImageList):
+            if self._keeps_size(images.image_sizes):
+                return self.forward_batched(images, targets)
+            images = images.unbatch()
         images = [img for img in images]
         if targets is not None:
             # make a copy of targets to avoid modifying it in-place
@@ -395,16 +436,38 @@ class GeneralizedRCNNTransform(nn.Module):
         image_list = ImageList(images, image_sizes_list)
         return image_list, targets
 
+    def _keeps_size(self, image_sizes: List[Tuple[int, int]]) -> bool:
+        """whether resize would leave every image of the batch at its size"""
+        if self.training:
+            if self._skip_resize:
+                return True
+            if len(self.min_size) > 1:
+                # random scale per image
+                return False
+        size = self.min_size[-1]
+        return all(_resized_size(h, w, size, self.max_size, self.fixed_size) == (h, w) for h, w in image_sizes)
+
+    def forward_batched(
+        self, images: ImageList, targets: Optional[List[Dict[str, Tensor]]] = None
+    ) -> Tuple[ImageList, Optional[List[Dict[str, Tensor]]]]:
+        """normalize a pre-batched ImageList whose images need no resizing, without per-image copies"""
+        batched = normalize_image(images.tensors, self.image_mean, self.image_std)
+        # padding has to stay 0 after normalization
+        for i, (h, w) in enumerate(images.image_sizes):
+            batched[i, :, h:, :] = 0
+            batched[i, :, :, w:] = 0
+        stride = self.size_divisible
+        pad_h = int(math.ceil(batched.shape[-2] / stride) * stride) - batched.shape[-2]
+        pad_w = int(math.ceil(batched.shape[-1] / stride) * stride) - batched.shape[-1]
+        if pad_h > 0 or pad_w > 0:
+            batched = torch.nn.functional.pad(batched, (0, pad_w, 0, pad_h))
+        if targets is not None:
+            targets = [{k: v for k, v in t.items()} for t in targets]
+        image_sizes = [(int(h), int(w)) for h, w in images.image_sizes]
+        return ImageList(batched, image_sizes), targets
+
     def normalize(self, image: Tensor) -> Tensor:
-        if not image.is_floating_point():
-            raise TypeError(
-                f"Expected input images to be of floating type (in range [0, 1]), "
-                f"but found type {image.dtype} instead"
-            )
-        dtype, device = image.dtype, image.device
-        mean = torch.as_tensor(self.image_mean, dtype=dtype, device=device)
-        std = torch.as_tensor(self.image_std, dtype=dtype, device=device)
-        return (image - mean[:, None, None]) / std[:, None, None]
+        return normalize_image(image, self.image_mean, self.image_std)
 
     def torch_choice(self, k: List[int]) -> int:
         """
@@ -426,6 +489,10 @@ class GeneralizedRCNNTransform(nn.Module):
             size = self.torch_choice(self.min_size)
         else:
             size = self.min_size[-1]
+        if not torchvision._is_tracing() and not torch.jit.is_scripting():
+            if _resized_size(int(h), int(w), size, self.max_size, self.fixed_size) == (h, w):
+                # already at the target size, e.g. from a pre-resized image cache
+                return image, target
         image, target = _resize_image_and_masks(image, size, self.max_size, target, self.fixed_size)
 
         if target is None:
@@ -3,6 +3,8 @@ import torch.nn as nn
 import numpy as np
 import math
 
+from network.amp import float32
+
 
 def bbox_iou(box1, box2, x1y1x2y2=True):
     """
@@ -54,6 +56,7 @@ class YOLOLoss(nn.Module):
         self.mse_loss = nn.MSELoss()
         self.bce_loss = nn.BCELoss()
 
+    @float32
     def forward(self, input, targets):
         device = input.device
         bs = input.size(0)
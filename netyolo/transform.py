@@ -5,8 +5,14 @@ import torchvision
 from torchvision.models.detection.transform import resize_boxes
 import torchvision.transforms.functional as F
 
+from network.transform import normalize_image
+from network.image_list import ImageList, batch_targets
+
 
 def resize_image(image, size):
+    if tuple(image.shape[-2:]) == tuple(size):
+        # already at the input size, e.g. from a pre-resized image cache
+        return image
     return nn.functional.interpolate(image[None], size, mode="bilinear")[0]
 
 
@@ -36,11 +42,17 @@ class YOLOTransform(nn.Module):
         self.image_std = image_std
 
     def forward(self, images, targets):
+        if isinstance(images, ImageList):
+            return self.forward_batched(images, targets)
         image_list, target_list = [], []
 
         for i in range(len(images)):
             image = images[i]
-            resized_image = F.normalize(resize_image(image, self.input_size), self.image_mean, self.image_std)
+            if image.dtype == torch.uint8:
+                # uint8 can not be interpolated, convert and normalize first in one pass
+                resized_image = resize_image(normalize_image(image, self.image_mean, self.image_std), self.input_size)
+            else:
+                resized_image = F.normalize(resize_image(image, self.input_size), self.image_mean, self.image_std)
 
             if self.training:
                 target = targets[i]
@@ -76,6 +88,53 @@ class YOLOTransform(nn.Module):
             out_targets = None
         
         return out_images, out_targets
+
+    def forward_batched(self, images, targets):
+        """
+        pre-batched ImageList and padded targets (see _utils.PaddedCollate),
+        same sized images are resized together and targets are converted without a per-image loop
+        """
+        image_sizes = images.image_sizes
+        if len(set(image_sizes)) == 1:
+            h, w = image_sizes[0]
+            batch = images.tensors[:, :, :h, :w]
+            if (h, w) == tuple(self.input_size):
+                out_images = normalize_image(batch, self.image_mean, self.image_std) if batch.dtype == torch.uint8 \
+                    else F.normalize(batch, self.image_mean, self.image_std)
+            elif batch.dtype == torch.uint8:
+                out_images = nn.functional.interpolate(normalize_image(batch, self.image_mean, self.image_std),
+                                                       self.input_size, mode="bilinear")
+            else:
+                out_images = F.normalize(nn.functional.interpolate(batch, self.input_size, mode="bilinear"),
+                                         self.image_mean, self.image_std)
+        else:
+            out_images = []
+            for image in images.unbatch():
+                if image.dtype == torch.uint8:
+                    out_images.append(resize_image(normalize_image(image, self.image_mean, self.image_std), self.input_size))
+                else:
+                    out_images.append(F.normalize(resize_image(image, self.input_size), self.image_mean, self.image_std))
+            out_images = torch.stack(out_images)
+
+        if not self.training:
+            return out_images, None
+
+        if not isinstance(targets, dict):
+            targets = batch_targets(list(targets))
+        boxes = targets["boxes"]
+        sizes = torch.as_tensor(image_sizes, dtype=torch.float32, device=boxes.device)
+        h = sizes[:, 0, None]
+        w = sizes[:, 1, None]
+        out_boxes = torch.stack([torch.div(boxes[..., 0] + boxes[..., 2], 2 * w),
+                                 torch.div(boxes[..., 1] + boxes[..., 3], 2 * h),
+                                 torch.div(boxes[..., 2] - boxes[..., 0], w),
+                                 torch.div(boxes[..., 3] - boxes[..., 1], h)], dim=2)
+        out_labels = (targets["labels"] - 1).float().unsqueeze(2)
+        out_targets = torch.cat([out_boxes, out_labels], 2)
+        # padding rows are all zero, they are ignored in the loss
+        valid = torch.arange(out_targets.shape[1], device=boxes.device)[None, :] < targets["num_boxes"].to(boxes.device)[:, None]
+        out_targets = out_targets * valid.unsqueeze(2)
+        return out_images, out_targets
     
     def postprocess(self, predictions, image_sizes):
         preds = torch.cat(predictions, 1)
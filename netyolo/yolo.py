@@ -1,5 +1,6 @@
 from torch import nn
 
+from network.image_list import ImageList
 from .transform import YOLOTransform
 from .yolo_util import Yolov3Body, Yolov7Body
 from .losses import YOLOLoss
@@ -30,7 +31,10 @@ class YOLOv3(nn.Module):
         self.losses = nn.ModuleList([YOLOLoss(self.num_classes, self.input_size, self.anchors[i]) for i in range(3)])
 
     def forward(self, images, targets=None):
-        or_images = images.copy()
+        if isinstance(images, ImageList):
+            img_sizes = list(images.image_sizes)
+        else:
+            img_sizes = [img.shape[1:] for img in images]
         images, gt = self.transform(images, targets)
         out0, out1, out2 = self.model(images)
         outputs = [out0, out1, out2]
@@ -50,7 +54,6 @@ class YOLOv3(nn.Module):
 
             return loss_dict
         else:
-            img_sizes = [img.shape[1:] for img in or_images]
             return self.transform.postprocess(pred, img_sizes)
         
 
@@ -79,7 +82,10 @@ class YOLOv7(nn.Module):
         self.losses = nn.ModuleList([YOLOLoss(self.num_classes, self.input_size, self.anchors[i]) for i in range(3)])
 
     def forward(self, images, targets=None):
-        or_images = images.copy()
+        if isinstance(images, ImageList):
+            img_sizes = list(images.image_sizes)
+        else:
+            img_sizes = [img.shape[1:] for img in images]
         images, gt = self.transform(images, targets)
         out0, out1, out2 = self.model(images)
         outputs = [out0, out1, out2]
@@ -99,5 +105,4 @@ class YOLOv7(nn.Module):
 
             return loss_dict
         else:
-            img_sizes = [img.shape[1:] for img in or_images]
             return self.transform.postprocess(pred, img_sizes)
\ No newline at end of file
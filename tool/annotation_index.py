@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Compile the fold/test csv files into a compact columnar annotation index.
+
+An index is a directory holding
+    boxes.npy    float32 [num_boxes, 4], xmin ymin xmax ymax of every box
+    offsets.npy  int64 [num_images + 1], boxes of image i are boxes[offsets[i]:offsets[i+1]]
+    meta.npz     path table, patient ids and the stat of the csv it was built from
+    sizes.npy    int64 [num_images, 2], H W of every image, read from the image
+                 headers the first time they are asked for
+
+boxes.npy and offsets.npy are memory-mapped when loaded, so every DataLoader
+worker shares the same pages instead of holding its own parsed copy.
+"""
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+
+INDEX_VERSION = 1
+
+
+def parse_annotation(annotation):
+    """
+    Parse one `annotation` cell, e.g. "0 112 1435 228 1589;0 67 190 310 352",
+    into a list of [xmin, ymin, xmax, ymax]. Every box is "label x y x y ...",
+    the box is the min/max of its points.
+    """
+    if type(annotation) != str or annotation == "":
+        return []
+    boxes = []
+    for anno in annotation.split(";"):
+        coords = anno.split(" ")[1:]
+        x = [float(c) for c in coords[0::2]]
+        y = [float(c) for c in coords[1::2]]
+        boxes.append([min(x), min(y), max(x), max(y)])
+    return boxes
+
+
+def default_index_dir(csv_path):
+    return os.path.splitext(csv_path)[0] + "_index"
+
+
+def _csv_stat(csv_path):
+    st = os.stat(csv_path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def _save_atomic(path, save, *args, **kwargs):
+    """save(path, ...) through a tmp file of this process, readers never see a partial file"""
+    ext = os.path.splitext(path)[1]
+    tmp_path = "{}.{}.tmp{}".format(path, os.getpid(), ext)
+    save(tmp_path, *args, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def compile_annotation_index(csv_path, index_dir=None):
+    """
+    Parse `csv_path` once and write its annotation index to `index_dir`
+    (default: next to the csv). Returns the index dir.
+    """
+    index_dir = index_dir or default_index_dir(csv_path)
+    os.makedirs(index_dir, exist_ok=True)
+    annotation = pd.read_csv(csv_path)
+
+    image_list = list(annotation["image_path"])
+    if "patient_id" in annotation:
+        patient_ids = [str(p) for p in annotation["patient_id"]]
+    else:
+        patient_ids = [""] * len(image_list)
+
+    offsets = np.zeros(len(image_list) + 1, dtype=np.int64)
+    boxes = []
+    for i, anno in enumerate(annotation["annotation"]):
+        image_boxes = parse_annotation(anno)
+        boxes.extend(image_boxes)
+        offsets[i + 1] = offsets[i] + len(image_boxes)
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+    sizes_path = os.path.join(index_dir, "sizes.npy")
+    if os.path.exists(sizes_path):
+        os.remove(sizes_path)
+    # several processes may build it at once (distributed ranks, parallel folds); every file is
+    # replaced whole, meta.npz last as the freshness check reads it
+    _save_atomic(os.path.join(index_dir, "boxes.npy"), np.save, boxes)
+    _save_atomic(os.path.join(index_dir, "offsets.npy"), np.save, offsets)
+    _save_atomic(os.path.join(index_dir, "meta.npz"), np.savez,
+                 version=np.array(INDEX_VERSION),
+                 csv_stat=_csv_stat(csv_path),
+                 image_path=np.array(image_list, dtype=np.str_),
+                 patient_id=np.array(patient_ids, dtype=np.str_))
+    return index_dir
+
+
+def _read_size(path):
+    # only reads the image header, no decoding
+    with Image.open(path) as img:
+        w, h = img.size
+    return (h, w)
+
+
+def _is_fresh(csv_path, index_dir):
+    meta_path = os.path.join(index_dir, "meta.npz")
+    if not os.path.exists(meta_path):
+        return False
+    with np.load(meta_path) as meta:
+        if int(meta["version"]) != INDEX_VERSION:
+            return False
+        return np.array_equal(meta["csv_stat"], _csv_stat(csv_path))
+
+
+class AnnotationIndex(object):
+    """
+    Read side of a compiled annotation index. The box arrays are opened
+    lazily, so an index pickled into a DataLoader worker re-maps the files
+    in the worker instead of copying them.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with np.load(os.path.join(index_dir, "meta.npz")) as meta:
+            self.image_list = meta["image_path"].tolist()
+            self.patient_ids = meta["patient_id"].tolist()
+        self._boxes = None
+        self._offsets = None
+
+    @classmethod
+    def from_csv(cls, csv_path, index_dir=None):
+        """load the index of `csv_path`, (re)compiling it if the csv changed"""
+        index_dir = index_dir or default_index_dir(csv_path)
+        if not _is_fresh(csv_path, index_dir):
+            compile_annotation_index(csv_path, index_dir)
+        return cls(index_dir)
+
+    def _open(self):
+        self._boxes = np.load(os.path.join(self.index_dir, "boxes.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(self.index_dir, "offsets.npy"), mmap_mode="r")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_boxes"] = None
+        state["_offsets"] = None
+        return state
+
+    def __len__(self):
+        return len(self.image_list)
+
+    def boxes(self, idx):
+        """[N, 4] read-only view of the boxes of image `idx`"""
+        if self._boxes is None:
+            self._open()
+        return self._boxes[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def num_boxes(self):
+        if self._offsets is None:
+            self._open()
+        return np.diff(self._offsets)
+
+    def all_boxes(self):
+        """(boxes, offsets) arrays of the whole index"""
+        if self._boxes is None:
+            self._open()
+        return self._boxes, self._offsets
+
+    def image_sizes(self, num_threads=16):
+        """[num_images, 2] H W of every image, read once from the image headers and kept in sizes.npy"""
+        sizes_path = os.path.join(self.index_dir, "sizes.npy")
+        if not os.path.exists(sizes_path):
+            with ThreadPoolExecutor(num_threads) as pool:
+                sizes = np.array(list(pool.map(_read_size, self.image_list)), dtype=np.int64).reshape(-1, 2)
+            # several processes may fill it at once, e.g. distributed training
+            _save_atomic(sizes_path, np.save, sizes)
+        return np.load(sizes_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile annotation index of TCT csv files")
+    parser.add_argument("csv", nargs="+", type=str, help="fold/test csv files")
+    args = parser.parse_args()
+    for csv_path in args.csv:
+        index_dir = compile_annotation_index(csv_path)
+        print(f"{csv_path} -> {index_dir}")
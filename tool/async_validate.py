@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Validation in a background process, overlapped with training.
+
+After every epoch the weights are copied into a shared memory state dict and
+the epoch is queued to an evaluation process (spawned, with its own device,
+torch threads and DataLoader workers), which runs `trainer.validate` on a
+copy of the model and sends the val mAP back through a result queue:
+
+    validator = AsyncValidator(model, dataloaders["val"], device, save_model_path=...)
+    for epoch in ...:
+        train_one_epoch(...)
+        validator.submit(epoch, model.state_dict())
+        for epoch_done, val_mAP in validator.poll():
+            checkpoints.report(epoch_done, val_mAP)
+    for epoch_done, val_mAP in validator.close():
+        ...
+
+The shared weights are reused from one epoch to the next, so `submit` only
+waits when the evaluation process has not even loaded the previous snapshot,
+i.e. when validation is more than one epoch behind. The output of the
+process (prints, progress bars) goes to val.log next to save_model_path.
+"""
+import copy
+import os
+import queue
+import sys
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+
+def _worker(model, weights, dataset, loader_kwargs, device, num_threads, eval_kwargs, jobs, results, free, log_path):
+    log = open(log_path, "a", buffering=1)
+    sys.stdout = sys.stderr = log
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    from trainer import validate
+    loader = DataLoader(dataset, shuffle=False, **loader_kwargs)
+    model.to(device)
+    while True:
+        epoch = jobs.get()
+        if epoch is None:
+            break
+        try:
+            model.load_state_dict(weights)
+            free.set()
+            val_mAP = validate(epoch, model, loader, device, **eval_kwargs)
+            results.put((epoch, val_mAP, None))
+        except Exception:
+            free.set()
+            traceback.print_exc()
+            results.put((epoch, None, traceback.format_exc()))
+            break
+    log.close()
+
+
+class AsyncValidator(object):
+    """
+    model: the model to validate (not the DistributedDataParallel wrapper), copied once to the process
+    loader: val DataLoader, its dataset, batch size, workers and collate_fn are used by the process
+    device: device the process validates on
+    num_threads: torch threads of the process, 0 for the torch default
+    eval_kwargs: save_model_path, amp, save_csv of trainer.validate
+    """
+    def __init__(self, model, loader, device, num_threads=0, **eval_kwargs):
+        ctx = mp.get_context("spawn")
+        eval_model = copy.deepcopy(model).cpu()
+        # torch.compile replaced the forward of some submodules (network.compile), validate eagerly
+        for m in eval_model.modules():
+            m.__dict__.pop("forward", None)
+        self.weights = {k: v.detach().to("cpu", copy=True).share_memory_() for k, v in eval_model.state_dict().items()}
+        loader_kwargs = {"batch_size": loader.batch_size, "num_workers": loader.num_workers,
+                         "collate_fn": loader.collate_fn}
+        log_path = os.path.join(os.path.dirname(eval_kwargs["save_model_path"]), "val.log")
+        self.pending = set()
+        self._jobs = ctx.Queue()
+        self._results = ctx.Queue()
+        self._free = ctx.Event()
+        self._free.set()
+        self._process = ctx.Process(target=_worker, args=(eval_model, self.weights, loader.dataset, loader_kwargs,
+                                                          device, num_threads, eval_kwargs, self._jobs, self._results,
+                                                          self._free, log_path))
+        self._process.start()
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            raise RuntimeError("background validation process exited with code {}".format(self._process.exitcode))
+
+    def submit(self, epoch, state_dict):
+        """copy `state_dict` into the shared weights and queue its validation"""
+        # the process has to have loaded the previous snapshot before it is overwritten
+        while not self._free.wait(timeout=10):
+            self._check_alive()
+        self._free.clear()
+        with torch.no_grad():
+            for k, v in state_dict.items():
+                self.weights[k].copy_(v)
+        self.pending.add(epoch)
+        self._jobs.put(epoch)
+
+    def _get(self, block):
+        epoch, val_mAP, error = self._results.get(block=block, timeout=10 if block else None)
+        if error is not None:
+            raise RuntimeError("background validation of epoch {} failed:\n{}".format(epoch, error))
+        self.pending.discard(epoch)
+        return epoch, val_mAP
+
+    def poll(self):
+        """[(epoch, val mAP)] of the validations finished since the last call, without blocking"""
+        done = []
+        while True:
+            try:
+                done.append(self._get(block=False))
+            except queue.Empty:
+                return done
+
+    def close(self):
+        """wait for the pending validations, stop the process and return their [(epoch, val mAP)]"""
+        done = self.poll()
+        while self.pending:
+            try:
+                done.append(self._get(block=True))
+            except queue.Empty:
+                self._check_alive()
+        self._jobs.put(None)
+        self._process.join()
+        return done
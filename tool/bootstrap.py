@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Patient level bootstrap confidence intervals of AP, F1 and FROC.
+
+The boxes are matched once (tool.voc_eval_new.match_detections); a bootstrap
+replicate draws the patients with replacement, which only changes how often
+every image, and so every pred box and ground box, is counted. With the
+replicate's patient counts as weights, the cumulative TP / FP of the boxes
+in score order are weighted cumsums and the AP / F1 / FROC of thousands of
+replicates are computed with array operations, a chunk of replicates at a
+time:
+
+    tp_cum[b] = cumsum(counts[b, patient of box] * tp)
+
+The copies of a box are ties next to each other in the score order, so the
+weighted curve gives the same AP as evaluating the resampled dataset.
+All models of a comparison use the same replicates (same seed).
+
+    python -m tool.bootstrap csvfiles/test.csv results/faster_loc.csv results/cascade_loc.csv \
+        --replicates 2000 --num_workers 4
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tool.annotation_index import AnnotationIndex
+from tool.voc_eval_new import FROC_FPS, match_detections, read_pred_csv
+
+
+def replicate_metrics(counts, box_patients, tp, fp, gt_per_patient, images_per_patient, fps_list=FROC_FPS):
+    """
+    AP, F1 and FROC of every replicate
+    counts: [B, P] number of times every patient is drawn in every replicate
+    box_patients: [n] patient of every pred box, boxes in decreasing score order
+    tp, fp: [n] 0 / 1 of every box
+    gt_per_patient, images_per_patient: [P] ground boxes and images of every patient
+    Returns {"AP", "F1", "FROC"} of [B] arrays, nan for replicates without ground boxes
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    num_object = counts @ gt_per_patient
+    num_image = counts @ images_per_patient
+    B, n = len(counts), len(tp)
+    if n == 0:
+        zeros = np.where(num_object > 0, 0., np.nan)
+        return {"AP": zeros, "F1": zeros, "FROC": zeros}
+    weights = counts[:, box_patients]
+    tp_cum = np.cumsum(weights * tp, axis=1)
+    fp_cum = np.cumsum(weights * fp, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rec = tp_cum / num_object[:, None]
+        prec = tp_cum / np.maximum(tp_cum + fp_cum, np.finfo(np.float64).eps)
+        # voc_ap: area under the precision envelope, summed over the recall steps
+        envelope = np.maximum.accumulate(prec[:, ::-1], axis=1)[:, ::-1]
+        ap = np.sum(np.diff(rec, axis=1, prepend=0.) * envelope, axis=1)
+        f1 = 2 * prec[:, -1] * rec[:, -1] / (prec[:, -1] + rec[:, -1] + 1e-16)
+        # tool.voc_eval_new.froc_sensitivity of every replicate
+        fp_rate = fp_cum / num_image[:, None]
+        reached = np.stack([np.sum(fp_rate < fps, axis=1) for fps in fps_list], axis=1)
+        found = reached < n
+        # unreached rates carry the highest reached one forward, all boxes if none is reached
+        last = np.where(found.any(axis=1), np.where(found, reached, -1).max(axis=1), n - 1)
+        reached = np.where(found, reached, last[:, None])
+        sensitivity = tp_cum[np.arange(B)[:, None], reached] / num_object[:, None]
+    froc = sensitivity.mean(axis=1)
+    invalid = num_object == 0
+    for metric in (ap, f1, froc):
+        metric[invalid] = np.nan
+    return {"AP": ap, "F1": f1, "FROC": froc}
+
+
+def _chunk(args):
+    return replicate_metrics(*args)
+
+
+class PatientBootstrap(object):
+    """
+    box_images: [n] image of every pred box, boxes in decreasing score order
+    tp, fp: [n] 0 / 1 of every box
+    gt_counts: [num_images] ground boxes of every image
+    patient_ids: [num_images] patient of every image, "" (no patient_id column in the csv) is refused:
+                 resampling a single patient gives zero width intervals
+    """
+    def __init__(self, box_images, tp, fp, gt_counts, patient_ids, fps_list=FROC_FPS):
+        self.patients, image_patients = np.unique(np.asarray(patient_ids, dtype=np.str_), return_inverse=True)
+        num_patients = len(self.patients)
+        assert "" not in self.patients, "not found patient ids, the gt csv needs a patient_id column."
+        assert num_patients > 1, "bootstrap needs more than one patient, found {}.".format(num_patients)
+        self.box_patients = image_patients[np.asarray(box_images, dtype=np.int64)]
+        self.tp = np.asarray(tp, dtype=np.float64)
+        self.fp = np.asarray(fp, dtype=np.float64)
+        self.gt_per_patient = np.bincount(image_patients, weights=gt_counts, minlength=num_patients)
+        self.images_per_patient = np.bincount(image_patients, minlength=num_patients).astype(np.float64)
+        self.fps_list = fps_list
+
+    def sample_counts(self, num_replicates, seed=0):
+        """[B, P] patient counts of num_replicates draws of all patients with replacement"""
+        num_patients = len(self.patients)
+        rng = np.random.default_rng(seed)
+        return rng.multinomial(num_patients, np.full(num_patients, 1. / num_patients), size=num_replicates)
+
+    def point(self):
+        """{"AP", "F1", "FROC"} of the dataset itself"""
+        counts = np.ones((1, len(self.patients)))
+        return {k: float(v[0]) for k, v in replicate_metrics(counts, self.box_patients, self.tp, self.fp,
+                                                             self.gt_per_patient, self.images_per_patient,
+                                                             self.fps_list).items()}
+
+    def run(self, num_replicates=1000, seed=0, num_workers=0, max_elements=4000000):
+        """
+        {"AP", "F1", "FROC"} of [num_replicates] bootstrap samples; replicates are
+        evaluated in chunks of about max_elements box weights, by num_workers processes
+        """
+        counts = self.sample_counts(num_replicates, seed)
+        chunk_size = max(1, max_elements // max(len(self.tp), 1))
+        jobs = [(counts[i:i + chunk_size], self.box_patients, self.tp, self.fp, self.gt_per_patient,
+                 self.images_per_patient, self.fps_list) for i in range(0, num_replicates, chunk_size)]
+        if num_workers > 0:
+            with ProcessPoolExecutor(num_workers) as pool:
+                parts = list(pool.map(_chunk, jobs))
+        else:
+            parts = [_chunk(job) for job in jobs]
+        return {k: np.concatenate([part[k] for part in parts]) for k in parts[0]}
+
+
+def confidence_intervals(samples, alpha=0.05):
+    """{metric: (low, high)} percentile intervals of bootstrap samples, replicates without ground boxes ignored"""
+    return {k: tuple(np.nanpercentile(v, [100 * alpha / 2, 100 * (1 - alpha / 2)]).tolist())
+            for k, v in samples.items()}
+
+
+def bootstrap_csv(index, pred_csv, label='1', ovthresh=0.5):
+    """PatientBootstrap of a prediction csv against the AnnotationIndex of its gt csv"""
+    boxes, offsets = index.all_boxes()
+    gt_counts = np.diff(offsets)
+    gt_boxes = {i: np.asarray(boxes[offsets[i]:offsets[i + 1]], dtype=np.float64)
+                for i in np.flatnonzero(gt_counts)}
+    image_ids = {p: i for i, p in enumerate(index.image_list)}
+    image_paths, pred_types, probabilities, coordinates = read_pred_csv(pred_csv)
+    keep = np.flatnonzero(pred_types == label)
+    missing = sorted(set(image_paths[i] for i in keep) - set(image_ids))
+    assert not missing, "not found {} prediction images in the gt csv, e.g. {}.".format(len(missing), missing[0])
+    box_images = np.array([image_ids[image_paths[i]] for i in keep], dtype=np.int64)
+    order, tp, fp = match_detections(box_images, probabilities[keep], coordinates[keep], gt_boxes, ovthresh)
+    return PatientBootstrap(box_images[order], tp, fp, gt_counts, index.patient_ids)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="patient level bootstrap CIs of AP, F1 and FROC")
+    parser.add_argument("gt_csv", type=str, help="gt csv with a patient_id column, e.g. csvfiles/test.csv")
+    parser.add_argument("pred_csv", type=str, nargs="+", help="prediction csvs (image_path,prediction) of the models")
+    parser.add_argument("--replicates", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.05, help="1 - confidence level")
+    parser.add_argument("--seed", type=int, default=0, help="same seed, same patient draws for every model")
+    parser.add_argument("--num_workers", type=int, default=0, help="processes evaluating the replicates")
+    args = parser.parse_args()
+
+    index = AnnotationIndex.from_csv(args.gt_csv)
+    print(f"{len(set(index.patient_ids))} patients, {len(index)} images, {args.replicates} replicates")
+    for pred_csv in args.pred_csv:
+        bootstrap = bootstrap_csv(index, pred_csv)
+        point = bootstrap.point()
+        intervals = confidence_intervals(bootstrap.run(args.replicates, args.seed, args.num_workers), args.alpha)
+        print(pred_csv)
+        for k, (low, high) in intervals.items():
+            print(f"    {k:<5s} {point[k]:.4f}  {100 * (1 - args.alpha):.0f}% CI [{low:.4f}, {high:.4f}]")
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Asynchronous, resumable training checkpoints.
+
+A checkpoint dir holds
+    epoch_000.pth ...   full training state of an epoch (model, optimizer,
+                        lr scheduler, grad scaler, RNG states, ...)
+    checkpoints.json    latest epoch and the validation metric of every epoch
+
+`CheckpointManager.save` copies the state into host buffers that are reused
+from one epoch to the next (pinned when cuda is available) and returns; a
+background thread writes the copy to a temp file and renames it in place,
+so a crash never leaves a half written checkpoint. Only the latest and the
+`keep_best` best checkpoints are kept.
+"""
+import json
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+INDEX_NAME = "checkpoints.json"
+
+
+def checkpoint_name(epoch):
+    return "epoch_{:03d}.pth".format(epoch)
+
+
+def saved_epochs(ckpt_dir):
+    """epochs with a checkpoint in `ckpt_dir`, [] if it holds none"""
+    index_path = os.path.join(ckpt_dir, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)["saved"]
+
+
+def rng_state():
+    """RNG states of python, numpy and torch (cpu and every cuda device)"""
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _atomic_write_json(obj, path):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """
+    ckpt_dir: dir of the checkpoints, created if missing
+    keep_best: number of best checkpoints (by the reported metric, higher is better) kept besides the latest
+
+    Epochs whose metric has not been reported yet are never removed.
+    """
+    def __init__(self, ckpt_dir, keep_best=3):
+        assert keep_best >= 1, "keep_best must be at least 1."
+        self.ckpt_dir = ckpt_dir
+        self.keep_best = keep_best
+        os.makedirs(ckpt_dir, exist_ok=True)
+        self.index_path = os.path.join(ckpt_dir, INDEX_NAME)
+        self.latest = None
+        self.saved = []
+        self.metrics = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.latest = index["latest"]
+            self.saved = index["saved"]
+            self.metrics = {int(k): v for k, v in index["metrics"].items()}
+
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._error = None
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ---- host side snapshot ----
+    def _snapshot(self, obj, key):
+        if isinstance(obj, torch.Tensor):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self._buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    # ---- background writer ----
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    job()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _write(self, epoch, state):
+        path = os.path.join(self.ckpt_dir, checkpoint_name(epoch))
+        tmp_path = path + ".tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if epoch not in self.saved:
+                self.saved.append(epoch)
+            self.latest = epoch
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            reported = sorted((e for e in self.saved if e in self.metrics),
+                              key=lambda e: (-self.metrics[e], e))
+            keep = set(reported[:self.keep_best]) | {self.latest}
+            keep |= set(e for e in self.saved if e not in self.metrics)
+            removed = [e for e in self.saved if e not in keep]
+            self.saved = [e for e in self.saved if e in keep]
+            index = {"latest": self.latest, "saved": list(self.saved),
+                     "metrics": {str(k): v for k, v in self.metrics.items()}}
+        _atomic_write_json(index, self.index_path)
+        for e in removed:
+            path = os.path.join(self.ckpt_dir, checkpoint_name(e))
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError("checkpoint writer failed") from self._error
+
+    # ---- public api ----
+    def save(self, epoch, state, metric=None):
+        """snapshot `state` (nested dicts / lists of tensors and python objects) and write it in the background"""
+        # the buffers of the previous snapshot are reused, so its write has to be done
+        self.wait()
+        snapshot = self._snapshot(state, ())
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if metric is not None:
+            with self._lock:
+                self.metrics[epoch] = metric
+        self._jobs.put(lambda: self._write(epoch, snapshot))
+
+    def report(self, epoch, metric):
+        """attach the validation metric of an epoch saved earlier"""
+        with self._lock:
+            self.metrics[epoch] = metric
+        self._jobs.put(self._prune)
+
+    def best(self):
+        """(epoch, metric) of the best reported epoch, earliest on ties; (None, None) before any report"""
+        with self._lock:
+            if not self.metrics:
+                return None, None
+            epoch = min(self.metrics, key=lambda e: (-self.metrics[e], e))
+            return epoch, self.metrics[epoch]
+
+    def load(self, epoch=None, map_location="cpu"):
+        """state of `epoch`, default the latest"""
+        self.wait()
+        epoch = self.latest if epoch is None else epoch
+        path = os.path.join(self.ckpt_dir, checkpoint_name(epoch))
+        assert epoch is not None and os.path.exists(path), "not found {} file.".format(path)
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def clear(self):
+        """forget and remove the checkpoints of an earlier run"""
+        self.wait()
+        with self._lock:
+            removed = self.saved
+            self.latest, self.saved, self.metrics = None, [], {}
+        for e in removed:
+            path = os.path.join(self.ckpt_dir, checkpoint_name(e))
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
+    def wait(self):
+        """block until every pending write is on disk"""
+        self._jobs.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self._jobs.put(None)
+        self._thread.join()
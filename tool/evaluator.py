@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+In-memory evaluation of the val / test predictions.
+
+The detections of every batch are kept as they come out of the model, in
+flat arrays (image index, label, score, box) of the boxes scoring above
+`score_thr`, and the ground boxes are taken from the annotation index of
+the dataset (tool/annotation_index.py). AP / mAP / F1 and FROC are computed
+from the arrays at the end of the epoch with tool.voc_eval_new, the result is
+the same as writing the prediction csv and running custom_voc_eval on it.
+Writing the csv is optional. The ious are computed once and matched at all
+`iou_thresholds` together for AP50, AP75 and the COCO style AP50:95.
+
+    evaluator = DetectionEvaluator.from_dataset(loader.dataset)
+    for image_ids, outputs in ...:
+        evaluator.update(image_ids, outputs)
+    evaluator.synchronize()     # distributed: merge the parts of every process
+    results = evaluator.summarize()
+"""
+import numpy as np
+import pandas as pd
+
+from tool import utils
+from tool.bootstrap import PatientBootstrap, confidence_intervals
+from tool.voc_eval_new import FROC_FPS, froc_sensitivity, voc_eval_arrays
+
+
+# iou thresholds of the COCO style AP50:95
+IOU_THRESHOLDS = tuple(np.round(np.arange(0.5, 0.96, 0.05), 2).tolist())
+
+
+class DetectionEvaluator(object):
+    """
+    image_list: image paths, the image ids of `update` index it
+    gt_boxes, gt_offsets: ground boxes of image i are gt_boxes[gt_offsets[i]:gt_offsets[i+1]],
+                          all counted as label '1' (like custom_voc_eval)
+    score_thr: only boxes scoring above it are kept, as in the prediction csv
+    iou_thresholds: iou thresholds of the AP50:95, matched in the same pass as ovthresh
+    patient_ids: patient of every image, for the bootstrap confidence intervals of `summarize`
+    """
+    def __init__(self, image_list, gt_boxes, gt_offsets, label_list=['1'], ovthresh=0.5, score_thr=0.5,
+                 fps_list=FROC_FPS, iou_thresholds=IOU_THRESHOLDS, patient_ids=None):
+        self.image_list = image_list
+        self.patient_ids = patient_ids
+        self.gt_counts = np.diff(np.asarray(gt_offsets))
+        self.label_list = label_list
+        self.ovthresh = ovthresh
+        self.iou_thresholds = iou_thresholds
+        self.score_thr = score_thr
+        self.fps_list = fps_list
+        gt_boxes = np.asarray(gt_boxes, dtype=np.float64)
+        self.object_dict = dict([(k, {}) for k in label_list])
+        self.object_dict['1'] = {i: gt_boxes[gt_offsets[i]:gt_offsets[i + 1]]
+                                 for i in range(len(image_list)) if gt_offsets[i + 1] > gt_offsets[i]}
+        self.reset()
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        """evaluator of a TCTDataset, ground boxes from its annotation index"""
+        gt_boxes, gt_offsets = dataset.index.all_boxes()
+        kwargs.setdefault("patient_ids", dataset.index.patient_ids)
+        return cls(dataset.image_list, gt_boxes, gt_offsets, **kwargs)
+
+    def reset(self):
+        self._chunks = []
+
+    def update(self, image_ids, outputs):
+        """image_ids: dataset index of every image of the batch, outputs: their detections (cpu tensors)"""
+        for image_id, output in zip(image_ids, outputs):
+            keep = output["scores"] > self.score_thr
+            n = int(keep.sum())
+            self._chunks.append((np.full(n, image_id, dtype=np.int64),
+                                 output["labels"][keep].numpy().astype(np.int64),
+                                 output["scores"][keep].float().numpy(),
+                                 output["boxes"][keep].float().numpy().reshape(-1, 4)))
+
+    def arrays(self):
+        """(image_ids, labels, scores, boxes) of all kept boxes, by image in dataset order"""
+        if len(self._chunks) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                    np.zeros(0, dtype=np.float32), np.zeros((0, 4), dtype=np.float32))
+        image_ids, labels, scores, boxes = (np.concatenate(a) for a in zip(*self._chunks))
+        # the boxes of an image keep the model's order, as in the csv
+        order = np.argsort(image_ids, kind="stable")
+        return image_ids[order], labels[order], scores[order], boxes[order]
+
+    def synchronize(self):
+        """merge the boxes of every process into the evaluator of each"""
+        if utils.get_world_size() == 1:
+            return
+        self._chunks = [tuple(part) for part in utils.all_gather(self.arrays())]
+
+    def predictions(self):
+        """prediction csv line ("label score x1 y1 x2 y2;...") of every image"""
+        image_ids, labels, scores, boxes = self.arrays()
+        lines = [[] for _ in self.image_list]
+        for image_id, label, score, box in zip(image_ids.tolist(), labels.tolist(), scores.tolist(), boxes.tolist()):
+            lines[image_id].append(" ".join(str(v) for v in [label, score] + box))
+        return [";".join(line) for line in lines]
+
+    def to_csv(self, path):
+        pd.DataFrame({"image_path": self.image_list, "prediction": self.predictions()}).to_csv(path, index=False)
+
+    def summarize(self, use_07_metric=False, bootstrap=0, alpha=0.05, seed=0):
+        """
+        bootstrap: number of patient bootstrap replicates (tool/bootstrap.py) of the
+                   confidence intervals "ci": {"AP", "F1", "FROC": (low, high)} of the first label
+        {"AP": {label: ap}, "mAP", "F1", "FROC", "sensitivity": {label: [sensitivity at every fps_list rate]},
+         "AP50", "AP75", "AP50:95": mean over the labels of the AP at iou 0.5, 0.75 and averaged over iou_thresholds,
+         "pr_curves": {label: {iou threshold: (recall, precision)}}},
+        FROC is the mean sensitivity of the first label
+        """
+        image_ids, labels, scores, boxes = self.arrays()
+        # float64 as parsed from the csv, the float32 values print and parse back exactly
+        AP_dict, mAP, mf1, curves = voc_eval_arrays(image_ids, labels.astype(str), scores.astype(np.float64),
+                                                    boxes.astype(np.float64), self.object_dict, self.label_list,
+                                                    self.ovthresh, use_07_metric, self.iou_thresholds)
+        sensitivity = {label: froc_sensitivity(c["tp"], c["fp"], c["num_object"], len(self.image_list), self.fps_list)
+                       for label, c in curves.items()}
+        results = {"AP": AP_dict, "mAP": mAP, "F1": mf1,
+                   "FROC": float(np.mean(sensitivity[self.label_list[0]])), "sensitivity": sensitivity,
+                   "pr_curves": {label: {t: (rec, prec) for t, (_, rec, prec) in c["iou"].items()}
+                                 for label, c in curves.items()}}
+        iou_ap = {t: float(np.mean([c["iou"][t][0] for c in curves.values()])) for t in self.iou_thresholds}
+        for name, t in (("AP50", 0.5), ("AP75", 0.75)):
+            if t in iou_ap:
+                results[name] = iou_ap[t]
+        if iou_ap:
+            results["AP50:95"] = float(np.mean(list(iou_ap.values())))
+        if bootstrap > 0:
+            assert self.patient_ids is not None, "bootstrap needs the patient ids of the images."
+            c = curves[self.label_list[0]]
+            bootstrapper = PatientBootstrap(image_ids[c["order"]], np.diff(c["tp"], prepend=0.),
+                                            np.diff(c["fp"], prepend=0.), self.gt_counts, self.patient_ids,
+                                            self.fps_list)
+            results["ci"] = confidence_intervals(bootstrapper.run(bootstrap, seed), alpha)
+        return results
@@ -1,15 +1,12 @@
 import argparse
-from collections import namedtuple
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from skimage.measure import points_in_poly
 import matplotlib.pyplot as plt
 
-
-Object = namedtuple('Object',
-                    ['image_path', 'object_id', 'object_type', 'coordinates',
-                     'hit_flag'])
-Prediction = namedtuple('Prediction',
-                        ['image_path','pred_type', 'probability', 'coordinates'])
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tool.voc_eval_new import froc_sensitivity, match_detections, read_gt_csv, read_pred_csv
 
 
 parser = argparse.ArgumentParser(description='Compute FROC')
@@ -23,160 +20,37 @@ parser.add_argument('gt_csv', default=None, metavar='GT_CSV',
 parser.add_argument('--type',default='1',type=str,
                     help="the object type of the froc curve {'1':'CTC','2':'CTC样'}")
 
-def inside_object(pred, obj):
-    # bounding box
-    if obj.object_type == '0':
-        x1, y1, x2, y2 = obj.coordinates
-        x, y = pred.coordinates
-        return x1 <= x <= x2 and y1 <= y <= y2
-    # bounding ellipse
-    if obj.object_type == '1':
-        x1, y1, x2, y2 = obj.coordinates
-        x, y = pred.coordinates
-        x_center, y_center = (x1 + x2) / 2, (y1 + y2) / 2
-        x_axis, y_axis = (x2 - x1) / 2, (y2 - y1) / 2
-        return ((x - x_center)/x_axis)**2 + ((y - y_center)/y_axis)**2 <= 1
-    # mask/polygon
-    if obj.object_type == '2':
-        num_points = len(obj.coordinates) // 2
-        poly_points = obj.coordinates.reshape(num_points, 2, order='C')
-        return points_in_poly(pred.coordinates.reshape(1, 2), poly_points)[0]
-
-
 def froc_curve(gt_csv,pred_csv,type,fps_list): 
+    """
+    sensitivity at every false positives per image rate of fps_list, the pred
+    boxes are matched to the ground boxes as in tool.voc_eval_new (each ground
+    box is hit once, later boxes on it are false positives)
+    """
     # iou overlap threshold, we set 0.5
     ovthresh = 0.5
-    # parse ground truth csv
-    num_image = 0
-    num_object = 0
-    object_dict = {}
+    # parse ground truth csv, every ground box is of type '1'
     with open(gt_csv) as f:
         # header
-        next(f)
-        for line in f:
-            image_path, annotation = line.strip('\n').split(',')
-
-            if annotation == '':
-                num_image += 1
-                continue
-
-            object_annos = annotation.split(';')
-            for object_anno in object_annos:
-                fields = object_anno.split(' ')
-                # object_type = fields[0]
-                object_type = '1'
-                if object_type == type:                    
-                    num_object += 1
-                    coords = np.array(list(map(float, fields[1:])))
-                    hit_flag = False
-                    obj = Object(image_path, num_object, object_type, coords,
-                                hit_flag)
-                    if image_path in object_dict:
-                        object_dict[image_path].append(obj)
-                    else:
-                        object_dict[image_path] = [obj]
-                    
-            num_image += 1
-
-    # parse prediction truth csv
-    preds = []
-    with open(pred_csv) as f:
-        # header
-        next(f)
-        for line in f:
-            image_path, prediction = line.strip('\n').split(',')
-
-            if prediction == '':
-                continue
+        num_image = sum(1 for _ in f) - 1
+    object_dict = read_gt_csv(gt_csv)['1'] if type == '1' else {}
+    num_object = sum(len(boxes) for boxes in object_dict.values())
 
-            coord_predictions = prediction.split(';')
-            for coord_prediction in coord_predictions:
-                fields = coord_prediction.split(' ')
-                pred_type = fields[0]
-                if pred_type == type:
-                    probability, x1, y1, x2, y2 = list(map(float, fields[1:]))
-                    pred = Prediction(image_path, pred_type, probability,
-                                    np.array([x1, y1, x2, y2]))
-                    preds.append(pred)
-    # sort prediction by probabiliyt
-    preds = sorted(preds, key=lambda x: x.probability, reverse=True)
-
-    # compute hits and false positives
-    hits = 0
-    false_positives = 0
-    fps_idx = 0
-    fps = fps_list
-    fps_flag = [str(i) for i in fps]
-    froc = []
-    for i in range(len(preds)):
-        pred = preds[i]
-        if pred.image_path in object_dict:
-            objs = object_dict[pred.image_path]
-            # gt boxes coords in this image
-            BBGT = np.array([k.coordinates for k in objs]).astype(float)
-            # gt boxes hit flag
-            BBGT_HIT_FLAG = [k.hit_flag for k in objs]
-            # this pred box coord
-            bb = pred.coordinates.astype(float)
-            # set the initial max iou
-            ovmax = -np.inf
-
-            if BBGT.size > 0:
-                # calculate ious between this box and every gt boxes
-                # on this image
-                ixmin = np.maximum(BBGT[:, 0], bb[0])
-                iymin = np.maximum(BBGT[:, 1], bb[1])
-                ixmax = np.minimum(BBGT[:, 2], bb[2])
-                iymax = np.minimum(BBGT[:, 3], bb[3])
-
-                # calculate overlap area width
-                iw = np.maximum(ixmax-ixmin+1., 0.)
-                # overlap area height
-                ih = np.maximum(iymax-iymin+1., 0.)
-                # overlap areas
-                inters = iw * ih
-                ## calculate ious
-                # union
-                union = ((bb[2]-bb[0]+1.)*(bb[3]-bb[1]+1.)+\
-                        (BBGT[:, 2]-BBGT[:, 0]+1.)*(BBGT[:, 3]-BBGT[:, 1]+1.)-\
-                        inters)
-                # ious
-                overlaps = inters / union
-                # find the maximum iou
-                ovmax = np.max(overlaps)
-                # find the maximum iou index
-                jmax = np.argmax(overlaps)
-
-            if ovmax > ovthresh:
-                if not BBGT_HIT_FLAG[jmax]:
-                    BBGT_HIT_FLAG[jmax] = True
-                    hits += 1
-                else:
-                    false_positives += 1
-            else:
-                false_positives += 1
-
-            if false_positives / num_image >= fps[fps_idx]:
-                sensitivity = hits / float(num_object)
-                froc.append(sensitivity)
-                fps_idx += 1
-
-                if len(fps) == len(froc):
-                    break
-
-        else:
-            false_positives += 1
+    # parse prediction csv
+    image_paths, pred_types, probabilities, coordinates = read_pred_csv(pred_csv)
+    index = np.flatnonzero(pred_types == type)
+    # hits and false positives in decreasing probability order
+    _, tp, fp = match_detections(np.asarray(image_paths)[index], probabilities[index], coordinates[index],
+                                 object_dict, ovthresh)
 
     print(f'gt框数量: {num_object}')
-    print(f'预测框数量: {len(preds)}')
-    print(f'TP框数量: {hits}')
-    print(f'FP框数量: {false_positives}')
-         
-    while len(froc) < len(fps):
-        froc.append(froc[-1])
+    print(f'预测框数量: {len(index)}')
+    print(f'TP框数量: {int(tp.sum())}')
+    print(f'FP框数量: {int(fp.sum())}')
+
+    froc = froc_sensitivity(np.cumsum(tp), np.cumsum(fp), num_object, num_image, fps_list).tolist()
 
     print("False positives per image:")
-    print("\t".join(fps_flag))
+    print("\t".join(str(i) for i in fps_list))
     print("Sensitivity:")
     print("\t".join(map(lambda x: "{:.3f}".format(x), froc)))
     print("FROC:")
@@ -219,8 +93,12 @@ if __name__ == '__main__':
     plt.grid(linestyle="dashed")
     labels = ['Faster R-CNN','Cascade R-CNN','Sparse R-CNN']
     # labels = ['SSD','Retina Net','FCOS']
+    # one process per model
+    with ProcessPoolExecutor(min(len(pred_csv), os.cpu_count())) as pool:
+        frocs = list(pool.map(froc_curve, [args.gt_csv] * len(pred_csv), pred_csv,
+                              [args.type] * len(pred_csv), [fps_list] * len(pred_csv)))
     for i in range(len(pred_csv)):  
-        froc = froc_curve(args.gt_csv,pred_csv[i],args.type,fps_list)
+        froc = frocs[i]
         ax.plot(fps_list, froc, 
                 linewidth=2,
                 color = palette(i+3),
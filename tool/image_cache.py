@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Decoded-pixel cache: every image is PNG-decoded once into a single
+memory-mapped uint8 file shared by all DataLoader workers, epochs, folds
+and runs.
+
+A cache is a directory holding
+    pixels.u8   HWC uint8 pixels of all images, back to back
+    index.npz   image_path, byte offset and (H, W, C) shape of every image
+
+Images are keyed by path, so one cache built from all fold/test csv files
+serves every fold. Building again with new paths appends them to the file.
+
+With a resize policy the cache stores the images already downscaled to the
+input size of a model family (see RESIZE_POLICIES), together with their
+original shape, so the model transform finds them at its target size and
+skips the interpolation. One cache dir holds a single policy.
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import torch
+import torchvision.transforms.functional as F
+from PIL import Image
+
+
+def _rcnn_size(h, w):
+    from network.transform import _resized_size
+    return _resized_size(h, w, 800, 1333)
+
+
+def _detr_size(h, w):
+    from netdetr.transform import get_size
+    return tuple(get_size((w, h), 800, 1333))
+
+
+def _bilinear(image, size):
+    return torch.nn.functional.interpolate(image[None], size=size, mode="bilinear", align_corners=False)[0]
+
+
+def _antialias(image, size):
+    return F.resize(image, list(size))
+
+
+# policy -> (output (h, w) of an (h, w) image, resize of a float CHW image),
+# both as done by the transform of the model family
+RESIZE_POLICIES = {
+    # FasterRCNN, CascadeRCNN, RetinaNet, FCOS, SparseRCNN (GeneralizedRCNNTransform, 800/1333)
+    "rcnn": (_rcnn_size, _bilinear),
+    # YOLOv3 / YOLOv7 (YOLOTransform, fixed input size)
+    "yolo416": (lambda h, w: (416, 416), _bilinear),
+    "yolo640": (lambda h, w: (640, 640), _bilinear),
+    # DETR (DETRTransform, 800/1333)
+    "detr": (_detr_size, _antialias),
+}
+
+
+def resized_shape(policy, h, w):
+    """
+    (h, w) an image is stored at under `policy`. Taken as a fixed point of the
+    policy so the model transform leaves it as is, rounding of the size can
+    make it a pixel off the size the transform makes of the full image.
+    Images the policy would upscale are stored as they are.
+    """
+    size_fn = RESIZE_POLICIES[policy][0]
+    size = tuple(int(s) for s in size_fn(h, w))
+    for _ in range(4):
+        again = tuple(int(s) for s in size_fn(*size))
+        if again == size:
+            break
+        size = again
+    if size[0] * size[1] >= h * w:
+        return (h, w)
+    return size
+
+
+def _read_shape(path):
+    # only reads the png header, no decoding
+    with Image.open(path) as img:
+        w, h = img.size
+    return (h, w, 3)
+
+
+def _decode_into(args):
+    pixel_path, path, offset, shape, policy = args
+    image = np.asarray(Image.open(path).convert('RGB'))
+    if policy:
+        # one thread per decoding process
+        torch.set_num_threads(1)
+        pixels = torch.tensor(image).permute(2, 0, 1).float()
+        pixels = RESIZE_POLICIES[policy][1](pixels, tuple(shape[:2]))
+        image = pixels.round_().clamp_(0, 255).to(torch.uint8).permute(1, 2, 0).numpy()
+    assert image.shape == tuple(shape), "{} changed while building the cache".format(path)
+    out = np.memmap(pixel_path, dtype=np.uint8, mode='r+', offset=offset, shape=tuple(shape))
+    out[:] = image
+    out.flush()
+    del out
+    return path
+
+
+def _load_index(cache_dir):
+    """image paths, offsets, stored shapes, original shapes and resize policy ('' for none)"""
+    index_path = os.path.join(cache_dir, 'index.npz')
+    if not os.path.exists(index_path):
+        empty = np.zeros((0, 3), dtype=np.int64)
+        return [], np.zeros(0, dtype=np.int64), empty, empty, None
+    with np.load(index_path) as index:
+        shapes = index['shapes']
+        orig_shapes = index['orig_shapes'] if 'orig_shapes' in index else shapes
+        policy = str(index['policy']) if 'policy' in index else ''
+        return index['image_path'].tolist(), index['offsets'], shapes, orig_shapes, policy
+
+
+def _map(fn, items, num_workers, chunksize):
+    """[fn(item)] in a pool of num_workers processes, in this process for num_workers <= 0"""
+    if num_workers <= 0:
+        return [fn(item) for item in items]
+    with Pool(num_workers) as pool:
+        return pool.map(fn, items, chunksize=chunksize)
+
+
+def build_image_cache(image_paths, cache_dir, num_workers=8, resize_policy=None):
+    """
+    Decode every image of `image_paths` not yet in the cache at `cache_dir`
+    and append it to the pixel file, downscaled by `resize_policy` if given
+    (a key of RESIZE_POLICIES). num_workers <= 0 decodes in this process,
+    like a DataLoader without workers. Returns the number of newly cached images.
+    """
+    policy = resize_policy or ''
+    assert policy == '' or policy in RESIZE_POLICIES, "unknown resize policy {}.".format(policy)
+    os.makedirs(cache_dir, exist_ok=True)
+    pixel_path = os.path.join(cache_dir, 'pixels.u8')
+    cached, offsets, shapes, orig_shapes, cached_policy = _load_index(cache_dir)
+    assert cached_policy is None or cached_policy == policy, \
+        "{} holds images of resize policy '{}', not '{}'.".format(cache_dir, cached_policy, policy)
+    cached_set = set(cached)
+    missing = [p for p in dict.fromkeys(image_paths) if p not in cached_set]
+    if len(missing) == 0:
+        return 0
+
+    new_orig_shapes = np.array(_map(_read_shape, missing, num_workers, 64), dtype=np.int64).reshape(-1, 3)
+    new_shapes = new_orig_shapes.copy()
+    if policy:
+        for s in new_shapes:
+            s[:2] = resized_shape(policy, int(s[0]), int(s[1]))
+    end = int(offsets[-1] + np.prod(shapes[-1])) if len(cached) else 0
+    sizes = np.prod(new_shapes, axis=1)
+    new_offsets = end + np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    # grow the file, bytes of already cached images are left untouched
+    with open(pixel_path, 'ab') as f:
+        f.truncate(end + int(sizes.sum()))
+    jobs = [(pixel_path, p, int(o), s, policy) for p, o, s in zip(missing, new_offsets, new_shapes)]
+    _map(_decode_into, jobs, num_workers, 16)
+
+    # publish the new index atomically, readers keep using the old one until reload
+    tmp_path = os.path.join(cache_dir, 'index.tmp.npz')
+    np.savez(tmp_path,
+             image_path=np.array(cached + missing, dtype=np.str_),
+             offsets=np.concatenate((offsets, new_offsets)).astype(np.int64),
+             shapes=np.concatenate((shapes, new_shapes)).astype(np.int64),
+             orig_shapes=np.concatenate((orig_shapes, new_orig_shapes)).astype(np.int64),
+             policy=np.array(policy))
+    os.replace(tmp_path, os.path.join(cache_dir, 'index.npz'))
+    return len(missing)
+
+
+class ImageCache(object):
+    """
+    Read side of a decoded-pixel cache. The pixel file is mapped lazily,
+    so a cache pickled into a DataLoader worker maps the file in the worker
+    and all workers read the same pages through the OS page cache.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        image_paths, self.offsets, self.shapes, self.orig_shapes, policy = _load_index(cache_dir)
+        # resize policy of the stored pixels, None for full resolution
+        self.policy = policy or None
+        self.slots = {p: i for i, p in enumerate(image_paths)}
+        self._pixels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pixels'] = None
+        return state
+
+    def __contains__(self, path):
+        return path in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def get(self, path):
+        """read-only HWC uint8 view of the pixels of `path`"""
+        if self._pixels is None:
+            self._pixels = np.memmap(os.path.join(self.cache_dir, 'pixels.u8'), dtype=np.uint8, mode='r')
+        slot = self.slots[path]
+        offset = int(self.offsets[slot])
+        shape = tuple(int(s) for s in self.shapes[slot])
+        return self._pixels[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def orig_size(self, path):
+        """(H, W) of `path` before the resize policy"""
+        slot = self.slots[path]
+        return (int(self.orig_shapes[slot][0]), int(self.orig_shapes[slot][1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="decode TCT images once into a memory-mapped cache")
+    parser.add_argument("csv", nargs="+", type=str, help="fold/test csv files")
+    parser.add_argument("--cache_dir", type=str, required=True, help="cache directory")
+    parser.add_argument("--num_workers", type=int, default=8, help="decoding processes")
+    parser.add_argument("--resize_policy", type=str, default=None, choices=sorted(RESIZE_POLICIES),
+                        help="store images pre-resized to the input size of a model family")
+    args = parser.parse_args()
+    paths = []
+    for csv_path in args.csv:
+        paths.extend(pd.read_csv(csv_path)['image_path'])
+    n = build_image_cache(paths, args.cache_dir, args.num_workers, args.resize_policy)
+    print(f"cached {n} new images in {args.cache_dir}")
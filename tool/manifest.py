@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Startup check that every image of a csv exists, done by a thread pool and
+remembered in a json manifest (path -> size, mtime).
+
+On the next run files listed in the manifest are trusted without a stat as
+long as the mtime of their directory is unchanged: adding, removing or
+renaming a file always bumps the mtime of its directory, so only one stat
+per directory is needed instead of one per image.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _load_manifest(manifest_path):
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return {"dirs": {}, "files": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def validate_paths(paths, manifest_path=None, num_threads=16):
+    """
+    Assert every file of `paths` exists. With `manifest_path` the result is
+    recorded there and reused by later runs. Returns the number of files stat'ed.
+    """
+    manifest = _load_manifest(manifest_path)
+    dirs = sorted(set(os.path.dirname(p) for p in paths))
+    with ThreadPoolExecutor(num_threads) as pool:
+        dir_stats = dict(zip(dirs, pool.map(_stat, dirs)))
+
+    def trusted(path):
+        d = os.path.dirname(path)
+        return (path in manifest["files"] and dir_stats[d] is not None
+                and manifest["dirs"].get(d) == dir_stats[d][1])
+
+    to_stat = [p for p in dict.fromkeys(paths) if not trusted(p)]
+    with ThreadPoolExecutor(num_threads) as pool:
+        file_stats = list(pool.map(_stat, to_stat))
+
+    missing = [p for p, st in zip(to_stat, file_stats) if st is None]
+    assert len(missing) == 0, "not found {} file. ({} missing in total)".format(missing[0], len(missing))
+
+    if manifest_path is not None and len(to_stat) > 0:
+        manifest["files"].update(zip(to_stat, file_stats))
+        manifest["dirs"].update((d, st[1]) for d, st in dir_stats.items() if st is not None)
+        tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+    return len(to_stat)
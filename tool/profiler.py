@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Phase level step profiler of the train / eval loops.
+
+Every step is cut into phases with `lap(name)`, which charges the time since
+the previous lap to `name`:
+
+    prof.begin_epoch()
+    for images, targets in loader:
+        prof.lap("data")          # waiting for the DataLoader
+        ...to_device...
+        prof.lap("h2d")
+        ...
+        prof.step(num_images)
+
+`report` prints the p50 / p90 / p99 of every phase, its share of the step
+time and the images/sec of the epoch, and writes them to TensorBoard and a
+json file. A large "data" share means the run is data bound.
+
+On cuda each lap synchronizes the device so kernels are charged to the phase
+that launched them; timing is off (laps are no-ops) unless enabled.
+Optionally the first `trace_steps` steps (after one warmup step) are traced
+by torch.profiler and exported as a chrome trace.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class StepProfiler(object):
+    """
+    name: loop name, e.g. "train", "val", "test"
+    device: synchronized before every lap when it is a cuda device
+    json_path: json file the epoch reports are appended to
+    trace_steps: number of steps traced by torch.profiler, 0 to disable
+    trace_path: chrome trace file
+    """
+    def __init__(self, name, enabled=True, device=None, json_path=None, trace_steps=0, trace_path=None):
+        self.name = name
+        self.enabled = enabled
+        self.sync = enabled and device is not None and torch.device(device).type == "cuda"
+        self.json_path = json_path
+        self.trace_steps = trace_steps if enabled else 0
+        self.trace_path = trace_path
+        self._trace = None
+        self._traced_steps = 0
+        self.begin_epoch()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def begin_epoch(self):
+        self.phases = OrderedDict()
+        self.step_time = []
+        self.images = 0
+        self.extra = OrderedDict()
+        self._current = OrderedDict()
+        if self.enabled:
+            if self.trace_steps > 0 and self._trace is None and self._traced_steps == 0:
+                self._start_trace()
+            self._last = self._now()
+
+    def lap(self, name):
+        """charge the time since the previous lap to phase `name`"""
+        if not self.enabled:
+            return
+        now = self._now()
+        self._current[name] = self._current.get(name, 0.0) + now - self._last
+        self._last = now
+
+    def step(self, num_images):
+        if not self.enabled:
+            return
+        self.lap("other")
+        total = 0.0
+        for name, seconds in self._current.items():
+            if name not in self.phases:
+                # phases first seen late count zero for the earlier steps
+                self.phases[name] = [0.0] * len(self.step_time)
+            self.phases[name].append(seconds)
+            total += seconds
+        for name, times in self.phases.items():
+            if name not in self._current:
+                times.append(0.0)
+        self.step_time.append(total)
+        self.images += num_images
+        self._current = OrderedDict()
+        if self._trace is not None:
+            self._trace.step()
+            self._traced_steps += 1
+            if self._traced_steps >= self.trace_steps + 1:
+                self._trace.__exit__(None, None, None)
+                self._trace = None
+
+    @contextmanager
+    def timed(self, name):
+        """time a one-off phase outside the steps, e.g. writing the prediction csv"""
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        yield
+        self.extra[name] = self.extra.get(name, 0.0) + self._now() - start
+        self._last = self._now()
+
+    def _start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.sync:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        trace_path = self.trace_path
+
+        def export(prof):
+            if trace_path:
+                prof.export_chrome_trace(trace_path)
+                print(f"{self.name} profiler trace saved to {trace_path}")
+
+        self._trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=0, warmup=1, active=self.trace_steps, repeat=1),
+            on_trace_ready=export)
+        self._trace.__enter__()
+
+    def summary(self):
+        """dict of the epoch: images/sec and percentiles (ms) and share of every phase"""
+        wall = float(np.sum(self.step_time))
+        phases = OrderedDict()
+        for name, times in self.phases.items():
+            times = np.asarray(times) * 1000
+            p50, p90, p99 = np.percentile(times, [50, 90, 99]) if len(times) else (0.0, 0.0, 0.0)
+            phases[name] = {"p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99),
+                            "mean_ms": float(times.mean()) if len(times) else 0.0,
+                            "share": float(times.sum() / 1000 / wall) if wall > 0 else 0.0}
+        return {"loop": self.name, "steps": len(self.step_time), "images": self.images,
+                "images_per_sec": self.images / wall if wall > 0 else 0.0,
+                "phases": phases, "extra_s": dict(self.extra)}
+
+    def report(self, epoch, writer=None):
+        if not self.enabled or len(self.step_time) == 0:
+            return None
+        summary = self.summary()
+        summary["epoch"] = epoch
+        print(f"{self.name} epoch{epoch} profile: {summary['images_per_sec']:.2f} img/s over {summary['steps']} steps")
+        for name, p in summary["phases"].items():
+            print(f"    {name:<12s} p50 {p['p50_ms']:9.2f}ms  p90 {p['p90_ms']:9.2f}ms  "
+                  f"p99 {p['p99_ms']:9.2f}ms  {100 * p['share']:5.1f}%")
+        for name, seconds in summary["extra_s"].items():
+            print(f"    {name:<12s} {seconds:.2f}s")
+
+        if writer:
+            writer.add_scalar(f'profile_{self.name}/images_per_sec', summary["images_per_sec"], epoch)
+            for name, p in summary["phases"].items():
+                writer.add_scalar(f'profile_{self.name}/{name}_p50_ms', p["p50_ms"], epoch)
+                writer.add_scalar(f'profile_{self.name}/{name}_share', p["share"], epoch)
+        if self.json_path:
+            records = []
+            if os.path.exists(self.json_path):
+                with open(self.json_path) as f:
+                    records = json.load(f)
+            records.append(summary)
+            tmp_path = "{}.{}.tmp".format(self.json_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(records, f, indent=2)
+            os.replace(tmp_path, self.json_path)
+        return summary
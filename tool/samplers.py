@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding=utf-8
+import math
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def padding_fraction(batches, image_sizes, size_divisible=32):
+    """fraction of the padded batch pixels that are zero padding"""
+    real = 0
+    padded = 0
+    for batch in batches:
+        sizes = image_sizes[batch]
+        h = math.ceil(sizes[:, 0].max() / size_divisible) * size_divisible
+        w = math.ceil(sizes[:, 1].max() / size_divisible) * size_divisible
+        real += int((sizes[:, 0] * sizes[:, 1]).sum())
+        padded += len(batch) * h * w
+    return 1.0 - real / max(padded, 1)
+
+
+class SizeBucketBatchSampler(Sampler):
+    """
+    Batch sampler that only batches images of similar shape together, so
+    little compute goes to zero padding when a batch is padded to its
+    largest image.
+
+    Images are ordered by aspect ratio, then area, and cut into `num_buckets`
+    equally sized buckets. Every epoch each bucket is shuffled and cut into
+    batches, and the batch order is shuffled across buckets.
+    `padding_fraction` holds the padding of the batches of the last epoch.
+
+    image_sizes: [N, 2] H W of every image, e.g. TCTDataset.index.image_sizes()
+    num_replicas, rank: for distributed training every rank takes every
+        num_replicas-th batch; the batch list is padded by repeating its first
+        batches so all ranks run the same number of steps
+    """
+    def __init__(self, image_sizes, batch_size, num_buckets=8, shuffle=True, drop_last=False,
+                 size_divisible=32, seed=0, num_replicas=1, rank=0):
+        self.image_sizes = np.asarray(image_sizes, dtype=np.int64).reshape(-1, 2)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.size_divisible = size_divisible
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.padding_fraction = None
+
+        h = self.image_sizes[:, 0]
+        w = self.image_sizes[:, 1]
+        order = np.lexsort((h * w, w / h))
+        num_buckets = max(1, min(num_buckets, len(order) // max(batch_size, 1)))
+        self.buckets = np.array_split(order, num_buckets)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            pad = (self.num_replicas - len(batches) % self.num_replicas) % self.num_replicas
+            batches += batches[:pad]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.padding_fraction = padding_fraction(batches, self.image_sizes, self.size_divisible)
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = sum(len(b) // self.batch_size for b in self.buckets)
+        else:
+            num_batches = sum(math.ceil(len(b) / self.batch_size) for b in self.buckets)
+        return math.ceil(num_batches / self.num_replicas)
+
+
+class DistributedEvalSampler(Sampler):
+    """
+    Every num_replicas-th index from `rank`, without the padding of
+    DistributedSampler, so that every image is evaluated exactly once;
+    ranks may get one image more than others.
+    """
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = list(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
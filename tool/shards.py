@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Pack the images of a fold csv into a few large shard files so an epoch
+reads big sequential chunks instead of opening tens of thousands of pngs.
+
+A shard dir holds
+    shard-00000.bin ...  the encoded png bytes of the images, back to back
+    index.npz            per image: path, patient id, shard number, byte offset
+                         and length, plus its boxes in annotation index layout
+                         (flat boxes + per image offsets)
+"""
+import argparse
+import os
+
+import numpy as np
+
+from .annotation_index import AnnotationIndex
+
+
+def shard_name(shard):
+    return "shard-{:05d}.bin".format(shard)
+
+
+def write_shards(csv_path, shard_dir, images_per_shard=1024, index_dir=None):
+    """pack the images of `csv_path` into `shard_dir`, returns the number of shards"""
+    os.makedirs(shard_dir, exist_ok=True)
+    index = AnnotationIndex.from_csv(csv_path, index_dir)
+    num_images = len(index)
+    shards = np.zeros(num_images, dtype=np.int32)
+    offsets = np.zeros(num_images, dtype=np.int64)
+    lengths = np.zeros(num_images, dtype=np.int64)
+
+    f = None
+    for i, path in enumerate(index.image_list):
+        if i % images_per_shard == 0:
+            if f is not None:
+                f.close()
+            f = open(os.path.join(shard_dir, shard_name(i // images_per_shard)), "wb")
+        with open(path, "rb") as img:
+            data = img.read()
+        shards[i] = i // images_per_shard
+        offsets[i] = f.tell()
+        lengths[i] = len(data)
+        f.write(data)
+    if f is not None:
+        f.close()
+
+    boxes, box_offsets = index.all_boxes()
+    np.savez(os.path.join(shard_dir, "index.npz"),
+             image_path=np.array(index.image_list, dtype=np.str_),
+             patient_id=np.array(index.patient_ids, dtype=np.str_),
+             shard=shards, offset=offsets, length=lengths,
+             boxes=np.asarray(boxes), box_offsets=np.asarray(box_offsets))
+    return int(shards[-1]) + 1 if num_images else 0
+
+
+class ShardIndex(object):
+    """read side of a shard dir"""
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with np.load(os.path.join(shard_dir, "index.npz")) as index:
+            self.image_list = index["image_path"].tolist()
+            self.patient_ids = index["patient_id"].tolist()
+            self.shard = index["shard"]
+            self.offset = index["offset"]
+            self.length = index["length"]
+            self._boxes = index["boxes"]
+            self._box_offsets = index["box_offsets"]
+        self.num_shards = int(self.shard.max()) + 1 if len(self.shard) else 0
+
+    def __len__(self):
+        return len(self.image_list)
+
+    def boxes(self, idx):
+        return self._boxes[self._box_offsets[idx]:self._box_offsets[idx + 1]]
+
+    def read_shard(self, shard):
+        """yield (idx, png bytes) of one shard with a single sequential pass over the file"""
+        ids = np.nonzero(self.shard == shard)[0]
+        ids = ids[np.argsort(self.offset[ids], kind="stable")]
+        with open(os.path.join(self.shard_dir, shard_name(shard)), "rb", buffering=16 << 20) as f:
+            for idx in ids:
+                f.seek(int(self.offset[idx]))
+                yield int(idx), f.read(int(self.length[idx]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pack TCT images into sequential shards")
+    parser.add_argument("csv", type=str, help="fold/test csv file")
+    parser.add_argument("shard_dir", type=str, help="output dir")
+    parser.add_argument("--images_per_shard", type=int, default=1024)
+    args = parser.parse_args()
+    n = write_shards(args.csv, args.shard_dir, args.images_per_shard)
+    print(f"{args.csv} -> {n} shards in {args.shard_dir}")
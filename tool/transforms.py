@@ -1,10 +1,9 @@
+import math
 import random
-import numpy as np
 import torch
 from torchvision.transforms import functional as F
-import PIL
-import imgaug.augmenters as iaa
-from imgaug.augmentables.bbs import BoundingBox, BoundingBoxesOnImage
+
+from network.image_list import ImageList
 
 
 def _flip_coco_person_keypoints(kps, width):
@@ -76,6 +75,14 @@ class ToTensor(object):
         return image, target
 
 
+class ToUint8Tensor(object):
+    '''将PIL图像转为uint8 Tensor, 转float与归一化推迟到模型的transform中'''
+    def __call__(self, image, target):
+        if not isinstance(image, torch.Tensor):
+            image = F.pil_to_tensor(image)
+        return image, target
+
+
 class Normalize(object):
     """
     Modified Normalize
@@ -88,35 +95,196 @@ class Normalize(object):
         return image, target
 
 
-class ImgAugTransform(object):
+# ITU-R 601 luma weights, as imgaug.Grayscale
+_GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def _flip_boxes(boxes, sizes, mask, horizontal):
+    '''boxes [B, M, 4], sizes [B, 2] (h, w), flip the boxes of the images in `mask`'''
+    x1, y1, x2, y2 = boxes.unbind(-1)
+    if horizontal:
+        w = sizes[:, 1, None].to(boxes.dtype)
+        flipped = torch.stack([w - x2, y1, w - x1, y2], -1)
+    else:
+        h = sizes[:, 0, None].to(boxes.dtype)
+        flipped = torch.stack([x1, h - y2, x2, h - y1], -1)
+    return torch.where(mask[:, None, None], flipped, boxes)
+
+
+def _rot90_boxes(boxes, sizes, k):
+    '''boxes [B, M, 4] of [h, w] images after torch.rot90(image, k[b], dims=(-2, -1))'''
+    x1, y1, x2, y2 = boxes.unbind(-1)
+    h = sizes[:, 0, None].to(boxes.dtype)
+    w = sizes[:, 1, None].to(boxes.dtype)
+    r1 = torch.stack([y1, w - x2, y2, w - x1], -1)
+    r2 = torch.stack([w - x2, h - y2, w - x1, h - y1], -1)
+    r3 = torch.stack([h - y2, x1, h - y1, x2], -1)
+    k = k[:, None, None]
+    return torch.where(k == 1, r1, torch.where(k == 2, r2, torch.where(k == 3, r3, boxes)))
+
+
+def _gaussian_blur(x, sigma):
+    '''x [B, C, H, W] float, per image sigma [B], separable kernels applied as one grouped conv'''
+    b, c, h, w = x.shape
+    radius = min(int(math.ceil(3 * float(sigma.max()))), h - 1, w - 1)
+    t = torch.arange(-radius, radius + 1, dtype=x.dtype, device=x.device)
+    kernel = torch.exp(-t[None] ** 2 / (2 * sigma[:, None].to(x.dtype).clamp(min=1e-3) ** 2))
+    kernel = (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(c, 0)
+    y = torch.nn.functional.pad(x.reshape(1, b * c, h, w), (radius, radius, radius, radius), mode='reflect')
+    y = torch.nn.functional.conv2d(y, kernel[:, None, :, None], groups=b * c)
+    y = torch.nn.functional.conv2d(y, kernel[:, None, None, :], groups=b * c)
+    return y.reshape(b, c, h, w)
+
+
+class BatchAugment(object):
     """
-    Use imgaug package to do data augmentation
+    Tensor version of the former imgaug policy
+        SomeOf((0, 3), [Fliplr(0.5), Flipud(0.5), OneOf(rotate 90/180/270),
+                        Multiply((0.8, 1.5), per_channel=0.5), Grayscale(0.6), GaussianBlur((0, 5))])
+    Parameters are drawn per image, boxes are transformed for the whole batch
+    with tensor arithmetic and brightness, grayscale and blur run as single
+    ops over the batch, on whatever device the images are.
+
+    Accepts and returns
+        - one [C, H, W] image and its target, as a Compose step in the workers
+        - a list of images and targets, as from _utils.collate_fn
+        - an ImageList and padded targets, as from _utils.PaddedCollate
+    uint8 (0-255) and float (0-1) images are both accepted. In an ImageList a
+    quarter turn that does not fit the padded shape is done as a half turn.
     """
-    def __init__(self):
-        # someof即每次从后续序列中选择部分项目,此处为0~3个项目
-        self.aug = iaa.SomeOf((0, 3), [
-            iaa.Fliplr(0.5),
-            iaa.Flipud(0.5),
-            iaa.OneOf([iaa.Affine(rotate=90),
-                    iaa.Affine(rotate=180),
-                    iaa.Affine(rotate=270)]),  # 旋转one of 角度
-            iaa.Multiply((0.8, 1.5),per_channel=0.5),  # 亮度变化
-            iaa.Grayscale(0.6),   # 灰度图                
-            iaa.GaussianBlur(sigma=(0.0, 5.0))  # 高斯扰动(变模糊)
-        ])
+    def __init__(self, max_ops=3, flip_prob=0.5, multiply=(0.8, 1.5), per_channel=0.5, gray_alpha=0.6, sigma=(0.0, 5.0)):
+        self.max_ops = max_ops
+        self.flip_prob = flip_prob
+        self.multiply = multiply
+        self.per_channel = per_channel
+        self.gray_alpha = gray_alpha
+        self.sigma = sigma
 
-    def __call__(self, image, target):
-        image = np.array(image)
-        bbs_list = []
-        boxes = target["boxes"].numpy()
-        for box in boxes:
-            bbs_ele = BoundingBox(x1=box[0], y1=box[1],
-                                  x2=box[2], y2=box[3])
-            bbs_list.append(bbs_ele)
-        bbs = BoundingBoxesOnImage(bbs_list, shape=image.shape)
-        seq_det = self.aug.to_deterministic()
-        image, boxes = seq_det(image=image, bounding_boxes=bbs)
-        boxes = np.array([[i.x1, i.y1, i.x2, i.y2]
-                          for i in boxes.bounding_boxes])
-        target["boxes"] = torch.as_tensor(boxes, dtype=torch.float32)
-        return PIL.Image.fromarray(image), target
\ No newline at end of file
+    def sample(self, b, c):
+        '''per image parameters of a batch of `b` images with `c` channels'''
+        n_ops = torch.randint(0, self.max_ops + 1, (b,))
+        # SomeOf: a random subset of n_ops of the 6 augmenters, applied in list order
+        chosen = torch.rand(b, 6).argsort(1).argsort(1) < n_ops[:, None]
+        factor = torch.empty(b, c).uniform_(*self.multiply)
+        shared = torch.rand(b) >= self.per_channel
+        factor[shared] = factor[shared, :1]
+        return {
+            "hflip": chosen[:, 0] & (torch.rand(b) < self.flip_prob),
+            "vflip": chosen[:, 1] & (torch.rand(b) < self.flip_prob),
+            "k": torch.where(chosen[:, 2], torch.randint(1, 4, (b,)), torch.zeros(b, dtype=torch.int64)),
+            "factor": torch.where(chosen[:, 3, None], factor, torch.ones(b, c)),
+            "alpha": chosen[:, 4].float() * self.gray_alpha,
+            "sigma": torch.where(chosen[:, 5], torch.empty(b).uniform_(*self.sigma), torch.zeros(b)),
+        }
+
+    def __call__(self, images, targets):
+        if isinstance(images, ImageList):
+            return self.augment_padded(images, targets)
+        if isinstance(images, torch.Tensor) and images.dim() == 3:
+            (image,), (target,) = self.augment_list([images], [targets])
+            return image, target
+        return self.augment_list(list(images), list(targets))
+
+    def augment_list(self, images, targets):
+        b, c = len(images), images[0].shape[0]
+        params = self.sample(b, c)
+        sizes = torch.tensor([img.shape[-2:] for img in images], dtype=torch.int64).reshape(-1, 2)
+        images = list(images)
+        for i in range(b):
+            image = images[i]
+            if params["hflip"][i]:
+                image = image.flip(-1)
+            if params["vflip"][i]:
+                image = image.flip(-2)
+            if params["k"][i] > 0:
+                image = torch.rot90(image, int(params["k"][i]), dims=(-2, -1))
+            images[i] = image
+        targets = self.augment_boxes(targets, sizes, params)
+
+        if len(set(img.shape for img in images)) == 1:
+            images = list(self.augment_pixels(torch.stack(images), params).unbind(0))
+        else:
+            for i in range(b):
+                one = {k: v[i:i + 1] for k, v in params.items()}
+                images[i] = self.augment_pixels(images[i][None], one)[0]
+        return images, targets
+
+    def augment_padded(self, images, targets):
+        x = images.tensors.clone()
+        b, c, pad_h, pad_w = x.shape
+        params = self.sample(b, c)
+        sizes = torch.tensor(images.image_sizes, dtype=torch.int64).reshape(-1, 2)
+        fits = (sizes[:, 1] <= pad_h) & (sizes[:, 0] <= pad_w)
+        params["k"] = torch.where((params["k"] % 2 == 1) & ~fits, torch.full_like(params["k"], 2), params["k"])
+        image_sizes = []
+        for i, (h, w) in enumerate(images.image_sizes):
+            image = x[i, :, :h, :w]
+            if params["hflip"][i]:
+                image = image.flip(-1)
+            if params["vflip"][i]:
+                image = image.flip(-2)
+            if params["k"][i] > 0:
+                image = torch.rot90(image, int(params["k"][i]), dims=(-2, -1))
+            if params["hflip"][i] or params["vflip"][i] or params["k"][i] > 0:
+                x[i].zero_()
+                x[i, :, :image.shape[-2], :image.shape[-1]] = image
+            image_sizes.append((int(image.shape[-2]), int(image.shape[-1])))
+
+        if isinstance(targets, dict) and "boxes" in targets:
+            targets = dict(targets)
+            params_dev = {k: v.to(targets["boxes"].device) for k, v in params.items()}
+            boxes = self._transform_boxes(targets["boxes"], sizes.to(targets["boxes"].device), params_dev)
+            # keep the padding rows zero
+            valid = torch.arange(boxes.shape[1], device=boxes.device)[None, :] < targets["num_boxes"].to(boxes.device)[:, None]
+            targets["boxes"] = boxes * valid[:, :, None]
+        elif not isinstance(targets, dict):
+            targets = self.augment_boxes(list(targets), sizes, params)
+
+        x = self.augment_pixels(x, params)
+        # padding has to stay 0
+        for i, (h, w) in enumerate(image_sizes):
+            x[i, :, h:, :] = 0
+            x[i, :, :, w:] = 0
+        return ImageList(x, image_sizes), targets
+
+    def augment_boxes(self, targets, sizes, params):
+        '''list of targets, boxes padded to [B, M, 4] and transformed together'''
+        if len(targets) == 0 or "boxes" not in targets[0]:
+            return targets
+        device = targets[0]["boxes"].device
+        num_boxes = [len(t["boxes"]) for t in targets]
+        boxes = torch.nn.utils.rnn.pad_sequence([t["boxes"].reshape(-1, 4) for t in targets], batch_first=True)
+        params = {k: v.to(device) for k, v in params.items()}
+        boxes = self._transform_boxes(boxes, sizes.to(device), params)
+        out = []
+        for t, box, n in zip(targets, boxes, num_boxes):
+            t = dict(t)
+            t["boxes"] = box[:n]
+            out.append(t)
+        return out
+
+    def _transform_boxes(self, boxes, sizes, params):
+        boxes = _flip_boxes(boxes, sizes, params["hflip"], horizontal=True)
+        boxes = _flip_boxes(boxes, sizes, params["vflip"], horizontal=False)
+        return _rot90_boxes(boxes, sizes, params["k"])
+
+    def augment_pixels(self, x, params):
+        '''brightness, grayscale and blur of a [B, C, H, W] batch'''
+        factor, alpha, sigma = params["factor"], params["alpha"], params["sigma"]
+        blur = sigma > 0.01
+        if (factor == 1).all() and (alpha == 0).all() and not blur.any():
+            return x
+        is_uint8 = x.dtype == torch.uint8
+        max_value = 255.0 if is_uint8 else 1.0
+        out = x.float()
+        out = (out * factor.to(out)[:, :, None, None]).clamp_(0, max_value)
+        if (alpha > 0).any():
+            weights = torch.tensor(_GRAY_WEIGHTS, dtype=out.dtype, device=out.device)[:, None, None]
+            gray = (out * weights).sum(1, keepdim=True)
+            out = out + alpha.to(out)[:, None, None, None] * (gray - out)
+        if blur.any():
+            idx = blur.nonzero().flatten().to(out.device)
+            out[idx] = _gaussian_blur(out[idx], sigma.to(out.device)[idx])
+        if is_uint8:
+            return out.round_().clamp_(0, 255).to(torch.uint8)
+        return out.to(x.dtype)
@@ -37,19 +37,12 @@ def voc_ap(recall, precision, use_07_metric=False):
     return ap
 
 
-def custom_voc_eval(gt_csv, pred_csv, label_list = ['1'], ovthresh=0.5, use_07_metric=False):
+def read_gt_csv(gt_csv, label_list=['1']):
     """
-    Do custom eval, include mAP and FROC,
-    gt_csv: path/to/ground_truth_csv
-    pred_csv: path/to/pred_csv
-    label_list
-    ovthresh: iou threshold
-    
+    ground boxes of a gt csv (image_path,annotation), every box counted as
+    label '1': {label: {image_path: [m, 4] array}}
     """
-    # parse ground truth csv, by parsing the ground truth csv,
-    # we get ground box info
-    object_dict = dict([(k,{}) for k in label_list])
-    obj_id = 0
+    coords = {}
     with open(gt_csv) as f:
         # skip header
         next(f)
@@ -57,123 +50,159 @@ def custom_voc_eval(gt_csv, pred_csv, label_list = ['1'], ovthresh=0.5, use_07_m
             image_path, annotation = line.strip("\n").split(",")
             if annotation == "":
                 continue
-            
-            object_annos = annotation.split(";")
-            for object_anno in object_annos:
-                fields = object_anno.split(" ")  # one box
-                # object_type = fields[0]
-                object_type = '1'
-                coords = np.array(list(map(float, fields[1:])))
-                
-                obj = Object(image_path, obj_id, object_type, coords)
-                if image_path in object_dict[obj.object_type]:
-                    object_dict[obj.object_type][image_path].append(obj)
-                else:
-                    object_dict[obj.object_type][image_path] = [obj]
-                obj_id += 1
-    
-    # parse prediction csv, by parsing pred csv, we get the pre box info
-    preds = []
+            # object_type = fields[0]
+            coords.setdefault(image_path, []).extend(
+                list(map(float, object_anno.split(" ")[1:])) for object_anno in annotation.split(";"))
+    object_dict = dict([(k,{}) for k in label_list])
+    object_dict['1'] = {k: np.array(v, dtype=np.float64).reshape(-1, 4) for k, v in coords.items()}
+    return object_dict
+
+
+def read_pred_csv(pred_csv):
+    """
+    pred boxes of a pred csv (image_path,prediction) as flat arrays, one row per box:
+    image paths (list), types (str array), probabilities [n] and coordinates [n, 4]
+    """
+    image_paths, pred_types, values = [], [], []
     with open(pred_csv) as f:
         # skip header
         next(f)
         for line in f:
             image_path, prediction = line.strip("\n").split(",")
-            
             if prediction == "":
                 continue
-
-            coord_predictions = prediction.split(";")
-            for coord_prediction in coord_predictions:
+            for coord_prediction in prediction.split(";"):
                 fields = coord_prediction.split(" ")
-                pred_type = fields[0]
-                probability, x1, y1, x2, y2 = list(map(float, fields[1:]))
-                pred = Prediction(image_path, pred_type, probability,
-                                  np.array([x1, y1, x2, y2]))
-                preds.append(pred)
+                image_paths.append(image_path)
+                pred_types.append(fields[0])
+                values.append(list(map(float, fields[1:])))
+    values = np.array(values, dtype=np.float64).reshape(-1, 5)
+    return image_paths, np.array(pred_types, dtype=str), values[:, 0], values[:, 1:]
+
+
+def voc_overlaps(boxes, gt_boxes):
+    """
+    [n, m] iou of n pred boxes and m ground boxes, +1 pixel convention of VOC
+    """
+    bb = boxes[:, None, :]
+    BBGT = gt_boxes[None, :, :]
+    ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+    iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+    ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+    iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+
+    # cal inter area width
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih  # inter area
+
+    union = (
+        (bb[..., 2] - bb[..., 0] + 1.) * (bb[..., 3] - bb[..., 1] + 1.) + \
+        (BBGT[..., 2] - BBGT[..., 0] + 1.) * (BBGT[..., 3] - BBGT[..., 1] + 1.) - \
+        inters
+    )
+    return inters / union
+
+
+def match_detections(image_ids, scores, boxes, gt_boxes, ovthresh=0.5):
+    """
+    Greedy VOC matching of the pred boxes of one label.
+    image_ids: [n] image of every pred box, key of gt_boxes
+    scores, boxes: [n], [n, 4]
+    gt_boxes: {image id: [m, 4] ground boxes}, images without ground boxes may be missing
+    ovthresh: iou threshold, or a vector of them matched together on the same ious
+    Returns the pred indices sorted by decreasing score (stable, ties keep their
+    order) and tp / fp [n] in that order, [len(ovthresh), n] for a vector.
+
+    In score order every pred box is compared with the ground boxes of its
+    image; it is a TP when its max iou is above ovthresh and the ground box of
+    that max was not hit by a higher scored box, else a FP. So a box is a TP
+    iff it is the first of the boxes above ovthresh with the same max ground box.
+    """
+    nd = len(scores)
+    order = np.argsort(-scores, kind="stable")
+    ovmax = np.full(nd, -np.inf)
+    gt_hit = np.zeros(nd, dtype=np.int64)  # global id of the max iou ground box
+
+    # iou matrix of every image in one go
+    sorted_ids = np.argsort(image_ids, kind="stable")
+    image_keys, starts = np.unique(np.asarray(image_ids)[sorted_ids], return_index=True)
+    gt_offset = 0
+    for image_id, idx in zip(image_keys, np.split(sorted_ids, starts[1:])):
+        BBGT = gt_boxes.get(image_id)
+        if BBGT is None or len(BBGT) == 0:
+            continue
+        overlaps = voc_overlaps(boxes[idx], BBGT)
+        ovmax[idx] = overlaps.max(axis=1)
+        gt_hit[idx] = overlaps.argmax(axis=1) + gt_offset
+        gt_offset += len(BBGT)
+
+    # the max ground box does not depend on the threshold, only whether it is hit
+    thresholds = np.atleast_1d(ovthresh)
+    ovmax, gt_hit = ovmax[order], gt_hit[order]
+    tp = np.zeros((len(thresholds), nd))
+    for t, thresh in enumerate(thresholds):
+        candidates = np.flatnonzero(ovmax > thresh)
+        _, first = np.unique(gt_hit[candidates], return_index=True)
+        tp[t, candidates[first]] = 1.
+    fp = 1. - tp
+    if np.ndim(ovthresh) == 0:
+        return order, tp[0], fp[0]
+    return order, tp, fp
 
 
+def pr_curve(tp, fp, num_object):
+    """recall and precision of cumulative tp / fp"""
+    # cal recall
+    rec = tp / float(num_object)
+    # cal precision
+    prec = tp / np.maximum(tp+fp, np.finfo(np.float64).eps)
+    return rec, prec
+
+
+def voc_eval_arrays(image_ids, pred_types, probabilities, coordinates, object_dict, label_list = ['1'],
+                    ovthresh=0.5, use_07_metric=False, iou_thresholds=()):
+    """
+    custom eval of flat pred box arrays, see custom_voc_eval
+    image_ids: [n] image of every pred box, key of the object_dict[label] dicts
+    pred_types: [n] str label of every pred box
+    probabilities, coordinates: [n], [n, 4]
+    object_dict: {label: {image id: [m, 4] ground boxes}}
+    iou_thresholds: more iou thresholds to compute the AP and PR curve at,
+                    matched together with ovthresh on the same ious
+    Returns AP_dict, mAP, mf1 and the curves of every label: {label: {
+        "order": indices of its pred boxes in decreasing score order,
+        "tp", "fp": cumulative tp / fp at ovthresh in that order,
+        "num_object": number of ground boxes,
+        "iou": {threshold: (ap, recall, precision)} of iou_thresholds}}
+    """
     AP_dict = {}
     f1_dict = {}
+    curves = {}
     for label in label_list:
-        label_preds = [pred for pred in preds if pred.pred_type == label]
-
-        # sort prediction by probability, decrease order
-        label_preds = sorted(label_preds, key=lambda x: x.probability, reverse=True)
-        nd = len(label_preds)  # total number of pred boxes
-        
-        object_hitted = set()
-        tp = np.zeros(nd)
-        fp = np.zeros(nd)
+        label_index = np.flatnonzero(pred_types == label)
+        order, tps, fps = match_detections(np.asarray(image_ids)[label_index], probabilities[label_index],
+                                           coordinates[label_index], object_dict[label],
+                                           np.array([ovthresh] + list(iou_thresholds), dtype=np.float64))
+        tp, fp = tps[0], fps[0]
 
         num_object = sum([len(obj) for obj in object_dict[label].values()])
 
-        # loop over each pred box to see if it matches one ground box
-        for d in range(nd):
-            if label_preds[d].image_path in object_dict[label]:
-                # one pred box coords
-                bb = label_preds[d].coordinates.astype(float)
-                image_path = label_preds[d].image_path
-                # set the initial max overlap iou
-                ovmax = -np.inf
-                # ground box on the image
-                R = [i.coordinates for i in object_dict[label][image_path]]
-                try:
-                    BBGT = np.stack(R, axis=0)
-                except ValueError:
-                    import ipdb;ipdb.set_trace()
-                R_img_id = [i.object_id for i in object_dict[label][image_path]]
-                BBGT_hitted_flag = np.stack(R_img_id, axis=0)
-
-                if BBGT.size > 0:
-                    # cal the iou between pred box and all the gt boxes on
-                    # the image
-                    ixmin = np.maximum(BBGT[:, 0], bb[0])
-                    iymin = np.maximum(BBGT[:, 1], bb[1])
-                    ixmax = np.minimum(BBGT[:, 2], bb[2])
-                    iymax = np.minimum(BBGT[:, 3], bb[3])
-
-                    # cal inter area width
-                    iw = np.maximum(ixmax - ixmin + 1., 0.)
-                    ih = np.maximum(iymax - iymin + 1., 0.)
-                    inters = iw * ih  # inter area
-
-                    union = (
-                        (bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) + \
-                        (BBGT[:, 2] - BBGT[:, 0] + 1.) * (BBGT[:, 3] - BBGT[:, 1] + 1.) - \
-                        inters
-                    )
-                    overlaps = inters / union
-                    # find the max iou
-                    ovmax = np.max(overlaps)
-                    # find the index of the max iou
-                    jmax = np.argmax(overlaps)
-                
-                
-                if ovmax > ovthresh:               
-                    if BBGT_hitted_flag[jmax] not in object_hitted:
-                        tp[d] = 1.
-                        object_hitted.add(BBGT_hitted_flag[jmax])
-                    else:
-                        fp[d] = 1.
-                else:
-                    fp[d] = 1.
-            else:
-                fp[d] = 1.
-
-        print(f'预测框数量: {len(label_preds)}')
+        print(f'预测框数量: {len(label_index)}')
         print(f'TP框数量: {sum(tp)}')
         print(f'FP框数量: {sum(fp)}')
           
         fp = np.cumsum(fp)
         tp = np.cumsum(tp)
-
-        # cal recall
-        rec = tp / float(num_object)
-        # cal precision
-        prec = tp / np.maximum(tp+fp, np.finfo(np.float64).eps)
+        rec, prec = pr_curve(tp, fp, num_object)
         ap = voc_ap(rec, prec, use_07_metric)
 
+        iou = {}
+        for thresh, tp_t, fp_t in zip(iou_thresholds, tps[1:], fps[1:]):
+            rec_t, prec_t = pr_curve(np.cumsum(tp_t), np.cumsum(fp_t), num_object)
+            iou[thresh] = (voc_ap(rec_t, prec_t, use_07_metric), rec_t, prec_t)
+        curves[label] = {"order": label_index[order], "tp": tp, "fp": fp, "num_object": num_object, "iou": iou}
+
         AP_dict[label] = ap
         
         f1 = 2 * prec * rec / (prec + rec + 1e-16)
@@ -184,9 +213,49 @@ def custom_voc_eval(gt_csv, pred_csv, label_list = ['1'], ovthresh=0.5, use_07_m
         mf1 = sum([f1[-1] for f1 in f1_dict.values()])/len(label_list)
     except IndexError:
         mf1 = 0.0
+    return AP_dict,mAP,mf1,curves
+
+
+def custom_voc_eval(gt_csv, pred_csv, label_list = ['1'], ovthresh=0.5, use_07_metric=False):
+    """
+    Do custom eval, include mAP and FROC,
+    gt_csv: path/to/ground_truth_csv
+    pred_csv: path/to/pred_csv
+    label_list
+    ovthresh: iou threshold
+    
+    """
+    # parse ground truth csv, by parsing the ground truth csv,
+    # we get ground box info
+    object_dict = read_gt_csv(gt_csv, label_list)
+    # parse prediction csv, by parsing pred csv, we get the pre box info
+    image_paths, pred_types, probabilities, coordinates = read_pred_csv(pred_csv)
+    AP_dict, mAP, mf1, _ = voc_eval_arrays(image_paths, pred_types, probabilities, coordinates, object_dict,
+                                           label_list, ovthresh, use_07_metric)
     return AP_dict,mAP,mf1
 
 
+# false positives per image of the FROC
+FROC_FPS = (0.125, 0.25, 0.5, 1, 2, 4, 8)
+
+
+def froc_sensitivity(tp, fp, num_object, num_image, fps_list):
+    """
+    sensitivity at every false positives per image rate of fps_list
+    tp, fp: cumulative tp / fp of the pred boxes in decreasing score order
+    The sensitivity at a rate is the one of the first box where the false
+    positives per image reach it. Rates the boxes never reach carry the
+    sensitivity of the highest reached rate forward (as the former froc.py),
+    if no rate is reached it is the sensitivity of all boxes.
+    """
+    if len(tp) == 0:
+        return np.zeros(len(fps_list))
+    reached = np.searchsorted(fp / float(num_image), np.asarray(fps_list, dtype=np.float64), side="left")
+    found = reached < len(tp)
+    last = reached[found].max() if found.any() else len(tp) - 1
+    return tp[np.where(found, reached, last)] / float(max(num_object, 1))
+
+
 if __name__ == "__main__":
     # gt_csv = "../statistic_description/tmp/test.csv"
     # pred_csv = "../tmp/detection_results/loc.csv"
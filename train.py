@@ -4,8 +4,10 @@
 train model
 """
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 
 import argparse
@@ -20,8 +22,12 @@ from netyolo import YOLOv3, YOLOv7
 from netdetr import DETR
 from tool import transforms as T
 import _utils
-from trainer import main_process
-from datasets import TCTDataset
+from trainer import freeze_bn, main_process, to_device
+from datasets import TCTCropDataset, TCTDataset, TCTShardDataset
+from tool.image_cache import RESIZE_POLICIES, ImageCache, build_image_cache
+from tool.samplers import DistributedEvalSampler, SizeBucketBatchSampler, padding_fraction
+from tool.checkpoint import CheckpointManager, saved_epochs
+from network.compile import compile_model, graph_break_report, print_report
 
 
 parser = argparse.ArgumentParser(description="TCT object detection")
@@ -33,12 +39,43 @@ parser.add_argument("--val_csv_path", type=str, default="./val.csv", help="val c
 parser.add_argument("--test_csv_path", type=str, default="./test.csv", help="test case path csv, default ./test.csv")
 parser.add_argument("--logdir", help="tensorboard log dir", type=str, default="./logs")
 parser.add_argument("--fold", help="train fold", type=int, default=1)
+parser.add_argument("--image_cache", help="decoded image cache dir, built on first use", type=str, default=None)
+parser.add_argument("--resize_policy", help="keep the image cache pre-resized to the input size of this model family", type=str, default=None, choices=sorted(RESIZE_POLICIES))
+parser.add_argument("--check_paths", help="eager: check all images exist at startup, lazy: on first load", type=str, default="eager", choices=["eager", "lazy"])
+parser.add_argument("--uint8_input", help="ship uint8 images from the workers, normalize in the model", action="store_true")
+parser.add_argument("--padded_collate", help="pad batches to one shared-memory tensor in the workers", action="store_true")
+parser.add_argument("--num_buckets", help="batch train images of similar size from this many buckets, 0 to disable", type=int, default=0)
+parser.add_argument("--augment", help="train augmentation: in the workers per image, or on device per batch after collate", type=str, default="none", choices=["none", "worker", "batch"])
+parser.add_argument("--crop_size", help="train on crops of this size around annotated cells, 0 for whole images", type=int, default=0)
+parser.add_argument("--background_rate", help="fraction of random background crops in crop mode", type=float, default=0.1)
+parser.add_argument("--min_visibility", help="drop boxes with less of their area inside the crop", type=float, default=0.5)
+parser.add_argument("--train_shards", help="read the train set from shards packed by tool/shards.py", type=str, default=None)
 # train param
 parser.add_argument("--train_batch_size", help="train batch size", type=int, default=8)
+parser.add_argument("--accum_steps", help="split each train batch into this many micro-batches and accumulate their gradients", type=int, default=1)
 parser.add_argument("--val_batch_size", help="val batch_size", type=int, default=1)
 parser.add_argument("--test_batch_size", help="test batch_size", type=int, default=1)
 parser.add_argument("--num_workers", help="number of workers", type=int, default=16)
+parser.add_argument("--amp", help="mixed precision: bf16 autocast on cpu, fp16 with grad scaling on cuda", action="store_true")
+parser.add_argument("--num_threads", help="torch intra-op threads, 0 for the torch default", type=int, default=0)
+parser.add_argument("--device", help="device to train on, default cuda:1 if available else cpu", type=str, default=None)
+parser.add_argument("--dist_url", help="url used to set up distributed training when launched by torchrun", type=str, default="env://")
 parser.add_argument("--num_epochs", help="number of Epoch", type=int, default=50)
+parser.add_argument("--compile", help="torch.compile the backbones, heads and YOLO / DETR bodies", action="store_true")
+parser.add_argument("--compile_bucket", help="with --compile, pad batches to a multiple of this to bound recompiles", type=int, default=128)
+parser.add_argument("--compile_report", help="list the graph breaks of the model on the first train batch in compile_report.json", action="store_true")
+parser.add_argument("--profile", help="time the phases of every train / eval step and report them per epoch", action="store_true")
+parser.add_argument("--profile_trace", help="with --profile, trace this many train steps with torch.profiler", type=int, default=0)
+parser.add_argument("--async_val", help="validate in a background process while the next epoch trains", action="store_true")
+parser.add_argument("--val_device", help="device of the background validation, default the train device", type=str, default=None)
+parser.add_argument("--val_threads", help="torch threads of the background validation, 0 for the torch default", type=int, default=0)
+parser.add_argument("--no_val_csv", help="do not write the val predictions to val_loc.csv every epoch", action="store_true")
+parser.add_argument("--bootstrap", help="patient bootstrap replicates of the test AP / F1 / FROC confidence intervals, 0 to disable", type=int, default=0)
+parser.add_argument("--log_every", help="fetch, print and check the train losses for nan every this many batches", type=int, default=100)
+parser.add_argument("--checkpoint_dir", help="dir of the per epoch training state checkpoints, default checkpoints next to save_model_path", type=str, default=None)
+parser.add_argument("--keep_best", help="number of best checkpoints kept besides the latest", type=int, default=3)
+parser.add_argument("--resume", help="continue from the latest checkpoint in checkpoint_dir", action="store_true")
+parser.add_argument("--overwrite_checkpoints", help="without --resume, delete the checkpoints of an earlier run in checkpoint_dir", action="store_true")
 parser.add_argument("--save_model_path", help="model saving dir", type=str, default="/home/stat-zx/TCTscidata/results/densenet169.pth")
 # optimizer
 subparsers = parser.add_subparsers(help="optimizer type", dest="optimizer_type")
@@ -52,37 +89,111 @@ sgd_parser.add_argument("--weight_decay", help="SGD weight decay", type=float, d
 adam_parser = subparsers.add_parser("AdamW")
 adam_parser.add_argument("--adamW_lr", help="Adam learning rate", type=float, default=2e-5)
 adam_parser.add_argument("--adamW_decay", help="Adam learning rate decay", type=float, default=0.0001)
-    
-args = parser.parse_args()
+
+
+def image_cache_dir(args):
+    '''pre-resized pixels go to one sub dir per policy next to the full resolution ones'''
+    return os.path.join(args.image_cache, args.resize_policy) if args.resize_policy else args.image_cache
 
 
 def main(args):
-    device = torch.device("cuda:1") if torch.cuda.is_available() else torch.device("cpu")
+    # torchrun sets RANK / WORLD_SIZE, then one process per device (or cpu socket)
+    _utils.init_distributed_mode(args)
+    if args.distributed:
+        device = torch.device("cuda", args.gpu) if torch.cuda.is_available() else torch.device("cpu")
+    elif args.device is not None:
+        device = torch.device(args.device)
+    else:
+        device = torch.device("cuda:1") if torch.cuda.is_available() else torch.device("cpu")
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     print(args)
+    checkpoint_dir = args.checkpoint_dir or os.path.join(os.path.dirname(args.save_model_path), "checkpoints")
+    # checked by every process before any work, never delete an earlier run by accident
+    if not args.resume and not args.overwrite_checkpoints:
+        assert not saved_epochs(checkpoint_dir), "found checkpoints of an earlier run in {}, " \
+            "pass --resume to continue it or --overwrite_checkpoints to delete them.".format(checkpoint_dir)
     CLASSES = {"__background__", "abnormal"}
     
     print("===============Loading data===============")
     data_transform = {
-        "train": T.Compose([
-            # T.ImgAugTransform(),
-            T.ToTensor()]),
+        "train": T.Compose([T.ToTensor()]),
         "val": T.Compose([T.ToTensor()]),
         "test": T.Compose([T.ToTensor()])
     }
 
-    dataset = TCTDataset(args.train_csv_path, transforms=data_transform["train"], train=True)
-    dataset_val = TCTDataset(args.val_csv_path, transforms=data_transform["val"], train=False)
-    dataset_test = TCTDataset(args.test_csv_path, transforms=data_transform["test"], train=False)
+    if args.uint8_input:
+        # 4x less data through the worker queues, the model transforms normalize
+        data_transform = {k: T.Compose([T.ToUint8Tensor()]) for k in data_transform}
+    if args.augment == "worker":
+        data_transform["train"] = T.Compose(data_transform["train"].transforms + [T.BatchAugment()])
+
+    if args.train_shards:
+        assert not args.distributed, "train_shards is not supported in distributed training."
+        # the shards hold the encoded images, decoded whole in the workers
+        assert args.crop_size == 0, "train_shards is not supported with crop_size."
+        if args.image_cache:
+            print("train images are read from train_shards, the image cache holds the val and test images only")
+
+    # indexes, manifests and the image cache are built once by the main process
+    with _utils.main_process_first():
+        if args.crop_size > 0:
+            dataset = TCTCropDataset(args.train_csv_path, transforms=data_transform["train"], crop_size=args.crop_size,
+                                     background_rate=args.background_rate, min_visibility=args.min_visibility,
+                                     check_paths=args.check_paths, uint8=args.uint8_input)
+        else:
+            dataset = TCTDataset(args.train_csv_path, transforms=data_transform["train"], train=True, check_paths=args.check_paths, uint8=args.uint8_input)
+        dataset_val = TCTDataset(args.val_csv_path, transforms=data_transform["val"], train=False, check_paths=args.check_paths, uint8=args.uint8_input)
+        dataset_test = TCTDataset(args.test_csv_path, transforms=data_transform["test"], train=False, check_paths=args.check_paths, uint8=args.uint8_input)
+        if args.bootstrap > 0:
+            # fail before training, not after the test run
+            assert "" not in dataset_test.index.patient_ids, "bootstrap needs a patient_id column in {}.".format(args.test_csv_path)
+        if args.image_cache:
+            # decode once, later folds and runs only map the cache
+            assert not (args.resize_policy and args.crop_size > 0), "crop mode needs the full resolution cache."
+            cache_dir = image_cache_dir(args)
+            train_images = [] if args.train_shards else dataset.image_list
+            n = build_image_cache(train_images + dataset_val.image_list + dataset_test.image_list,
+                                  cache_dir, args.num_workers, args.resize_policy)
+            print(f"cached {n} new images in {cache_dir}")
+            image_cache = ImageCache(cache_dir)
+            for d in (dataset, dataset_val, dataset_test):
+                d.image_cache = image_cache
+
+    if args.train_shards:
+        # shuffling happens inside the shard dataset
+        dataset = TCTShardDataset(args.train_shards, transforms=data_transform["train"], train=True, uint8=args.uint8_input)
 
     print("====Creating dataloader====")
-    dataloader = DataLoader(dataset, batch_size=args.train_batch_size, shuffle=True, num_workers=args.num_workers, collate_fn=_utils.collate_fn)
-    dataloader_val = DataLoader(dataset_val, batch_size=args.val_batch_size, shuffle=False, num_workers=args.num_workers, collate_fn=_utils.collate_fn)
-    dataloader_test = DataLoader(dataset_test, batch_size=args.test_batch_size, shuffle=False,num_workers=args.num_workers, collate_fn=_utils.collate_fn)
+    assert args.train_batch_size % args.accum_steps == 0, "train_batch_size must be divisible by accum_steps."
+    micro_batch_size = args.train_batch_size // args.accum_steps
+    size_divisible = args.compile_bucket if args.compile else 32
+    collate_fn = _utils.PaddedCollate(size_divisible=size_divisible) if args.padded_collate else _utils.collate_fn
+    if args.num_buckets > 0 and not args.train_shards and args.crop_size == 0:
+        image_sizes = dataset.index.image_sizes()
+        batch_sampler = SizeBucketBatchSampler(image_sizes, micro_batch_size, num_buckets=args.num_buckets,
+                                               num_replicas=_utils.get_world_size(), rank=_utils.get_rank())
+        shuffled = np.array_split(np.random.permutation(len(dataset)), len(batch_sampler))
+        print(f"padding fraction: shuffled {padding_fraction(shuffled, image_sizes):.4f}, "
+              f"bucketed {padding_fraction(batch_sampler.batches(), image_sizes):.4f}")
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+    elif args.distributed:
+        dataloader = DataLoader(dataset, batch_size=micro_batch_size, sampler=DistributedSampler(dataset, shuffle=True), num_workers=args.num_workers, collate_fn=collate_fn)
+    else:
+        dataloader = DataLoader(dataset, batch_size=micro_batch_size, shuffle=not args.train_shards, num_workers=args.num_workers, collate_fn=collate_fn)
+    # every process evaluates its part of the val / test set, trainer merges the predictions
+    val_sampler, test_sampler = None, None
+    if args.distributed:
+        val_sampler = DistributedEvalSampler(dataset_val, _utils.get_world_size(), _utils.get_rank())
+        test_sampler = DistributedEvalSampler(dataset_test, _utils.get_world_size(), _utils.get_rank())
+    dataloader_val = DataLoader(dataset_val, batch_size=args.val_batch_size, shuffle=False, sampler=val_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+    dataloader_test = DataLoader(dataset_test, batch_size=args.test_batch_size, shuffle=False, sampler=test_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
     dataloaders = {"train": dataloader, "val": dataloader_val, "test": dataloader_test,}
 
     logdir = args.logdir
     os.makedirs(logdir, exist_ok=True)
-    writer = SummaryWriter(logdir)
+    main_rank = _utils.is_main_process()
+    writer = SummaryWriter(logdir) if main_rank else None
     
     print("===============Loading model===============")
     # SSD
@@ -119,6 +230,14 @@ def main(args):
     
     model.to(device)
     print(model)
+    if args.compile_report and main_rank:
+        images, targets = to_device(*next(iter(dataloaders["train"])), device)
+        model.train()
+        model.apply(freeze_bn)
+        print_report(graph_break_report(model, images, targets),
+                     os.path.join(os.path.dirname(args.save_model_path), "compile_report.json"))
+    if args.compile:
+        print("compiled:", ", ".join(compile_model(model, args.compile_bucket)))
     print("===============Setting optimizer===============")
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
@@ -131,16 +250,31 @@ def main(args):
         optimizer = torch.optim.AdamW(params, lr=args.adamW_lr, weight_decay=args.adamW_decay)
         lr_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.num_epochs)
 
+    if args.distributed:
+        # frozen BN parameters must not be expected to get gradients
+        model.apply(freeze_bn)
+        model = DistributedDataParallel(model, device_ids=[args.gpu] if device.type == "cuda" else None)
+    checkpoints = CheckpointManager(checkpoint_dir, args.keep_best) if main_rank else None
     print("===============Start training===============")
     start_time = time.time()
-    main_process(model=model, optimizer=optimizer, lr_sche=lr_scheduler,
-                 dataloaders=dataloaders, num_epochs=args.num_epochs, use_tensorboard=True,
-                 device=device, save_model_path=args.save_model_path,
-                 fold=args.fold, writer=writer)
+    metrics = main_process(model=model, optimizer=optimizer, lr_sche=lr_scheduler,
+                           dataloaders=dataloaders, num_epochs=args.num_epochs, use_tensorboard=main_rank,
+                           device=device, save_model_path=args.save_model_path,
+                           fold=args.fold, writer=writer,
+                           augment=T.BatchAugment() if args.augment == "batch" else None,
+                           amp=args.amp, accum_steps=args.accum_steps,
+                           checkpoints=checkpoints, resume=args.resume, overwrite_checkpoints=args.overwrite_checkpoints,
+                           log_every=args.log_every, profile=args.profile, profile_trace=args.profile_trace,
+                           async_val=args.async_val, val_threads=args.val_threads, save_val_csv=not args.no_val_csv,
+                           bootstrap=args.bootstrap,
+                           val_device=torch.device(args.val_device) if args.val_device else None)
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print('Training time {}'.format(total_time_str))
+    metrics["train_time"] = total_time
+    return metrics
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -1,8 +1,9 @@
 import math
 import sys
 import os
+from contextlib import nullcontext
 import torch
-import pandas as pd
+from torch.nn.parallel import DistributedDataParallel
 from sklearn.metrics import roc_auc_score, roc_curve, auc
 
 import sys
@@ -10,10 +11,15 @@ sys.path.append(".")
 sys.path.append("..")
 import tool.utils as utils
 from tool.voc_eval import write_custom_voc_results_file, do_python_eval
-from tool.voc_eval_new import custom_voc_eval
+from tool.evaluator import DetectionEvaluator
+from network.image_list import ImageList, unbatch_targets
+from network.transform import resize_boxes
+from network.amp import autocast_dtype, grad_scaler
+from tool.checkpoint import CheckpointManager, rng_state, set_rng_state
+from tool.profiler import StepProfiler
+from tool.async_validate import AsyncValidator
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
-import copy
 
 
 def freeze_bn(m):
@@ -24,135 +30,271 @@ def freeze_bn(m):
         m.bias.requires_grad = False
 
 
-def train_one_epoch(epoch, model, loader, optimizer, lr_scheduler, device, writer=None):
+def to_device(images, targets, device):
+    '''move a batch from either collate_fn or _utils.PaddedCollate to device'''
+    if isinstance(images, ImageList):
+        images = images.to(device)
+    else:
+        images = list(image.to(device) for image in images)
+    if isinstance(targets, dict):
+        targets = {k: v.to(device) for k, v in targets.items()}
+    else:
+        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    return images, targets
+
+
+def num_images(images):
+    return images.tensors.shape[0] if isinstance(images, ImageList) else len(images)
+
+
+def to_original_size(outputs, targets):
+    '''map predicted boxes of pre-resized images (targets with "orig_size", see datasets.resize_target) back to the original image'''
+    if isinstance(targets, dict):
+        targets = unbatch_targets(targets) if len(targets) else []
+    for output, target in zip(outputs, targets):
+        if "orig_size" in target:
+            output["boxes"] = resize_boxes(output["boxes"], target["size"].tolist(), target["orig_size"].tolist())
+    return outputs
+
+
+class LossAccumulator(object):
+    '''
+    running sums of the loss components, kept on device so that the train
+    loop does not sync with the device for every step; `flush` moves the
+    sums of the steps since the last flush to the host in one transfer,
+    averaged over the processes in distributed training
+    '''
+    def __init__(self):
+        self.names = None
+        self.epoch_sum = None
+        self.window_sum = None
+        self.epoch_steps = 0
+        self.window_steps = 0
+
+    def add(self, loss_dict):
+        if self.names is None:
+            self.names = list(loss_dict)
+        values = [loss_dict[k] for k in self.names]
+        # statistics may be python numbers (the match count of SparseRCNN)
+        device = next((v.device for v in values if torch.is_tensor(v)), None)
+        step = torch.stack([torch.as_tensor(v, device=device).detach().float().sum() for v in values])
+        if self.window_sum is None:
+            self.epoch_sum = torch.zeros_like(step)
+            self.window_sum = torch.zeros_like(step)
+        self.window_sum += step
+        self.window_steps += 1
+
+    def flush(self):
+        '''mean of every component over the steps since the last flush'''
+        if utils.is_dist_avail_and_initialized():
+            torch.distributed.all_reduce(self.window_sum)
+            self.window_sum /= utils.get_world_size()
+        self.epoch_sum += self.window_sum
+        self.epoch_steps += self.window_steps
+        means = dict(zip(self.names, (v / max(self.window_steps, 1) for v in self.window_sum.tolist())))
+        self.window_sum.zero_()
+        self.window_steps = 0
+        return means
+
+    def epoch_means(self):
+        if self.epoch_sum is None:
+            return {}
+        return dict(zip(self.names, (v / self.epoch_steps for v in self.epoch_sum.tolist())))
+
+
+def mark_last(iterable):
+    '''(item, is_last) of every item, the last one is found by looking one item ahead'''
+    items = iter(iterable)
+    try:
+        prev = next(items)
+    except StopIteration:
+        return
+    for item in items:
+        yield prev, False
+        prev = item
+    yield prev, True
+
+
+def train_one_epoch(epoch, model, loader, optimizer, lr_scheduler, device, writer=None, augment=None, amp=False,
+                    accum_steps=1, scaler=None, log_every=100, profiler=None):
+    '''
+    augment: optional batch augmentation (tool.transforms.BatchAugment) run on device after collate
+    amp: run the forward pass under autocast (bf16 on cpu, fp16 with grad scaling on cuda)
+    accum_steps: the loader yields micro-batches, gradients of accum_steps of them are
+                 summed into one logical batch before the optimizer and lr scheduler step
+    scaler: grad scaler kept across epochs, made here if amp needs one and none is given
+    log_every: the losses stay on device and are only fetched, logged and checked
+               for nan / inf every log_every steps and at the end of the epoch
+    profiler: optional tool.profiler.StepProfiler timing the phases of every step
+    '''
     model.train()
     model.apply(freeze_bn)
-    train_loss = 0.0
+    if accum_steps > 1 and any(isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.training
+                               for m in model.modules()):
+        print("warning: BatchNorm layers in train mode see micro-batch statistics with gradient accumulation")
+    meter = LossAccumulator()
+    if scaler is None:
+        scaler = grad_scaler(device, amp)
+    # only the x axis of the step curves, an IterableDataset may yield a few batches more or less
+    num_batches = len(loader)
+    profiler = profiler or StepProfiler(None, enabled=False)
+    profiler.begin_epoch()
 
-    for i, (images, targets) in enumerate(tqdm(loader), 0):
-        images = list(image.to(device) for image in images)
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
-        loss_dict = model(images, targets)
-        losses = sum(loss for loss in loss_dict.values())
-        loss_value = losses.item()
-        train_loss += loss_value
-        
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            print(loss_dict)
-            sys.exit(1)
-
-        if (i+1) % 100 == 0:
-            print(f'batch{i+1} loss:{loss_value:.4f}')
-        losses.backward()
-        optimizer.step()
-        lr_scheduler.step()
-        optimizer.zero_grad()
-
-    print(f'epoch{epoch} loss:{train_loss/len(loader):.4f}')
+    for i, ((images, targets), last) in enumerate(mark_last(tqdm(loader))):
+        profiler.lap("data")
+        images, targets = to_device(images, targets, device)
+        profiler.lap("h2d")
+        if augment is not None:
+            images, targets = augment(images, targets)
+            profiler.lap("augment")
+        step_optimizer = (i+1) % accum_steps == 0 or last
+        # ddp all-reduces gradients only on the last micro-batch of a logical batch
+        no_sync = model.no_sync() if isinstance(model, DistributedDataParallel) and not step_optimizer else nullcontext()
+        with no_sync:
+            with torch.autocast(device.type, dtype=autocast_dtype(device), enabled=amp):
+                loss_dict = model(images, targets)
+            # python numbers in the loss dict are statistics, logged but not trained on
+            losses = sum(loss.float() for loss in loss_dict.values() if torch.is_tensor(loss))
+            meter.add(loss_dict)
+            profiler.lap("forward")
+
+            if (i+1) % log_every == 0 or last:
+                window = meter.flush()
+                loss_value = sum(window.values())
+                # nan / inf of any step of the window propagates into its sum
+                if not math.isfinite(loss_value):
+                    print("Loss is {}, stopping training".format(loss_value))
+                    print(window)
+                    sys.exit(1)
+                if (i+1) % log_every == 0:
+                    print(f'batch{i+1} loss:{loss_value:.4f}')
+                    if writer:
+                        for k, v in window.items():
+                            writer.add_scalar(f'train_step/{k}', v, epoch * num_batches + i)
+                profiler.lap("log")
+            # mean over the micro-batches of the logical batch
+            losses = losses / accum_steps
+            if scaler is not None:
+                scaler.scale(losses).backward()
+            else:
+                losses.backward()
+            profiler.lap("backward")
+
+        if step_optimizer:
+            group_size = i % accum_steps + 1
+            if group_size < accum_steps:
+                # the last logical batch of the epoch is short, its mean is over group_size micro-batches
+                for group in optimizer.param_groups:
+                    for p in group["params"]:
+                        if p.grad is not None:
+                            p.grad.mul_(accum_steps / group_size)
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+            profiler.lap("optimizer")
+        profiler.step(num_images(images))
+
+    epoch_means = meter.epoch_means()
+    train_loss = sum(epoch_means.values())
+    print(f'epoch{epoch} loss:{train_loss:.4f}')
     if writer:
-        writer.add_scalar('train/loss', train_loss, epoch)  
+        # epoch sum of the batch losses as in earlier runs, the mean under its own tag
+        writer.add_scalar('train/loss', train_loss * meter.epoch_steps, epoch)
+        writer.add_scalar('train/loss_mean', train_loss, epoch)
+        for k, v in epoch_means.items():
+            writer.add_scalar(f'train/{k}', v, epoch)
+    profiler.report(epoch, writer)
+    padding = getattr(loader.batch_sampler, 'padding_fraction', None)
+    if padding is not None:
+        print(f'epoch{epoch} padding fraction:{padding:.4f}')
+        if writer:
+            writer.add_scalar('train/padding_fraction', padding, epoch)
 
 
-def validate(epoch, model, loader, device, save_model_path, fold):                   
+def predict(model, loader, device, evaluator, amp=False, profiler=None):
+    '''feed the detections of every image of `loader` to `evaluator` (tool.evaluator.DetectionEvaluator)'''
     model.eval()
-    locs = []
-    for i, (image, _) in enumerate(tqdm(loader)):
-        image = list(img.to(device) for img in image)
-        with torch.no_grad():
-            outputs = model(image)
+    profiler = profiler or StepProfiler(None, enabled=False)
+    profiler.begin_epoch()
+    # dataset index of the images of every batch, also for a distributed sampler
+    batch_indices = iter(loader.batch_sampler)
+    for images, targets in tqdm(loader):
+        profiler.lap("data")
+        images, _ = to_device(images, [], device)
+        profiler.lap("h2d")
+        with torch.no_grad(), torch.autocast(device.type, dtype=autocast_dtype(device), enabled=amp):
+            outputs = model(images)
+        profiler.lap("forward")
         outputs = [{k: v.cpu() for k, v in t.items()} for t in outputs]
+        outputs = to_original_size(outputs, targets)
+        assert len(outputs) == num_images(images), "expected one output per image."
+        evaluator.update(next(batch_indices), outputs)
+        profiler.lap("postprocess")
+        profiler.step(num_images(images))
+    # every process evaluated its part of the dataset
+    evaluator.synchronize()
 
-        if len(outputs[-1]["boxes"]) == 0:
-            # if no pred boxes, means that the image is negative
-            locs.append("")
-        else:
-            # we keep those pred boxes whose score is more than 0.5
-            new_output_index = torch.where(outputs[-1]["scores"] > 0.5)
-            new_boxes = outputs[-1]["boxes"][new_output_index]
-            new_scores = outputs[-1]["scores"][new_output_index]
-            new_labels = outputs[-1]["labels"][new_output_index]
-            # used to save pred coords x1 y1 x2 y2
-            # used to save pred box scores
-            coords = [] 
-            for i in range(len(new_boxes)):
-                new_box = new_boxes[i].tolist()
-                coords.append([new_box[0], new_box[1],
-                               new_box[2], new_box[3]])
-            coords_score = new_scores.tolist()
-            coords_labels = new_labels.tolist()
-            line = ""
-            for i in range(len(new_boxes)):
-                if i == len(new_boxes) - 1:
-                    line += str(coords_labels[i]) + ' ' + str(coords_score[i]) + ' ' +  \
-                            str(coords[i][0]) + ' ' + str(coords[i][1]) + ' ' + \
-                            str(coords[i][2]) + ' ' + str(coords[i][3])
-                else:
-                    line += str(coords_labels[i]) + ' ' + str(coords_score[i]) + ' ' + \
-                            str(coords[i][0]) + ' ' + str(coords[i][1]) + ' ' + \
-                            str(coords[i][2]) + ' ' + str(coords[i][3]) + ';'
-
-            locs.append(line)
-    loc_res = pd.DataFrame({"image_path": loader.dataset.image_list,
-                            "prediction": locs})
-    valpath = os.path.join(os.path.dirname(save_model_path),'val_loc.csv')
-    loc_res.to_csv(valpath, index=False)
-    valap_dict,val_mAP,valmf1 = custom_voc_eval(gt_csv=f'/home/stat-zx/TCTdet/csvfiles/fold{fold}/val.csv', pred_csv=valpath) 
-    print(f"Epoch: {epoch}, | val TCT AP :{valap_dict['1']:.4f}")
-    print(f"Epoch: {epoch}, | val mAP: {val_mAP:.4f}")    
-
-    return val_mAP
-
-
-def summary(model, loader, device, save_model_path):
-    model.eval()
-    locs = []
-    for i, (image, _) in enumerate(tqdm(loader)):
-        image = list(img.to(device) for img in image)
-        with torch.no_grad():
-            outputs = model(image)
-        outputs = [{k: v.cpu() for k, v in t.items()} for t in outputs]
 
-        if len(outputs[-1]["boxes"]) == 0:
-            # if no pred boxes, means that the image is negative
-            locs.append("")
-        else:
-            # we keep those pred boxes whose score is more than 0.5
-            new_output_index = torch.where(outputs[-1]["scores"] > 0.5)
-            new_boxes = outputs[-1]["boxes"][new_output_index]
-            new_scores = outputs[-1]["scores"][new_output_index]
-            new_labels = outputs[-1]["labels"][new_output_index]
-            # used to save pred coords x1 y1 x2 y2
-            # used to save pred box scores
-            coords = [] 
-            for i in range(len(new_boxes)):
-                new_box = new_boxes[i].tolist()
-                coords.append([new_box[0], new_box[1],
-                               new_box[2], new_box[3]])
-            coords_score = new_scores.tolist()
-            coords_labels = new_labels.tolist()
-            line = ""
-            for i in range(len(new_boxes)):
-                if i == len(new_boxes) - 1:
-                    line += str(coords_labels[i]) + ' ' + str(coords_score[i]) + ' ' +  \
-                            str(coords[i][0]) + ' ' + str(coords[i][1]) + ' ' + \
-                            str(coords[i][2]) + ' ' + str(coords[i][3])
-                else:
-                    line += str(coords_labels[i]) + ' ' + str(coords_score[i]) + ' ' + \
-                            str(coords[i][0]) + ' ' + str(coords[i][1]) + ' ' + \
-                            str(coords[i][2]) + ' ' + str(coords[i][3]) + ';'
-
-            locs.append(line)
-    loc_res = pd.DataFrame({"image_path": loader.dataset.image_list,
-                            "prediction": locs})
+def evaluate(model, loader, device, csv_path=None, amp=False, profiler=None, bootstrap=0):
+    '''
+    results of tool.evaluator.DetectionEvaluator.summarize on the main process,
+    None on the others; csv_path: optionally write the predictions there
+    bootstrap: number of patient bootstrap replicates of the confidence intervals, 0 for none
+    '''
+    evaluator = DetectionEvaluator.from_dataset(loader.dataset)
+    predict(model, loader, device, evaluator, amp, profiler)
+    if not utils.is_main_process():
+        return None
+    profiler = profiler or StepProfiler(None, enabled=False)
+    if csv_path:
+        with profiler.timed("csv"):
+            evaluator.to_csv(csv_path)
+    with profiler.timed("voc_eval"):
+        return evaluator.summarize(bootstrap=bootstrap)
+
+
+def validate(epoch, model, loader, device, save_model_path, amp=False, profiler=None, writer=None, save_csv=True):
+    '''save_csv: also write the predictions to val_loc.csv next to save_model_path'''
+    valpath = os.path.join(os.path.dirname(save_model_path),'val_loc.csv') if save_csv else None
+    results = evaluate(model, loader, device, valpath, amp, profiler)
+    if results is None:
+        # evaluated on the main process
+        return utils.broadcast_object(None)
+    if profiler is not None:
+        profiler.report(epoch, writer)
+    print(f"Epoch: {epoch}, | val TCT AP :{results['AP']['1']:.4f}")
+    print(f"Epoch: {epoch}, | val mAP: {results['mAP']:.4f}")    
+    print(f"Epoch: {epoch}, | val F1-score: {results['F1']:.4f}, FROC: {results['FROC']:.4f}")
+    print(f"Epoch: {epoch}, | val AP75: {results['AP75']:.4f}, AP50:95: {results['AP50:95']:.4f}")
+
+    return utils.broadcast_object(results['mAP'])
+
+
+def summary(model, loader, device, save_model_path, amp=False, profiler=None, writer=None, bootstrap=0):
+    '''
+    test results (see tool.evaluator.DetectionEvaluator.summarize), predictions written to test_loc.csv
+    bootstrap: number of patient bootstrap replicates of the 95% confidence intervals, 0 for none
+    '''
     testpath = os.path.join(os.path.dirname(save_model_path),'test_loc.csv')
-    loc_res.to_csv(testpath, index=False)
-    testap_dict,test_mAP,testmf1 = custom_voc_eval(gt_csv="/home/stat-zx/TCTdet/csvfiles/test.csv", pred_csv=testpath) 
-    print(f"Test TCT AP :{testap_dict['1']:.4f}")
-    print(f"Test mAP: {test_mAP:.4f}")
-    print(f"Test F1-score: {testmf1:.4f}")
+    results = evaluate(model, loader, device, testpath, amp, profiler, bootstrap)
+    if results is None:
+        # evaluated on the main process
+        return utils.broadcast_object(None)
+    if profiler is not None:
+        profiler.report(0, writer)
+    print(f"Test TCT AP :{results['AP']['1']:.4f}")
+    print(f"Test mAP: {results['mAP']:.4f}")
+    print(f"Test F1-score: {results['F1']:.4f}")
+    print(f"Test FROC: {results['FROC']:.4f}")
+    print(f"Test AP75: {results['AP75']:.4f}, AP50:95: {results['AP50:95']:.4f}")
+    for k, (low, high) in results.get("ci", {}).items():
+        print(f"Test {k} 95% CI (patient bootstrap, {bootstrap} replicates): [{low:.4f}, {high:.4f}]")
 
-    return test_mAP
+    return utils.broadcast_object(results)
 
 
 def main_process(model, optimizer, lr_sche,
@@ -161,28 +303,150 @@ def main_process(model, optimizer, lr_sche,
                   device,
                   save_model_path,
                   fold,
-                  writer=None):
-
-    best_score = 0.0
-
-    for epoch in range(num_epochs):
-        train_one_epoch(epoch, model, dataloaders['train'], optimizer, lr_sche, device, writer)
-        val_mAP = validate(epoch, model, dataloaders['val'], device, save_model_path, fold)
-        
-        if val_mAP > best_score:
-            best_score = val_mAP
-            best_epoch = epoch
-            best_stat_dict = copy.deepcopy(model.state_dict())
-        
+                  writer=None,
+                  augment=None,
+                  amp=False,
+                  accum_steps=1,
+                  checkpoints=None,
+                  resume=False,
+                  overwrite_checkpoints=False,
+                  log_every=100,
+                  profile=False,
+                  profile_trace=0,
+                  async_val=False,
+                  val_device=None,
+                  val_threads=0,
+                  save_val_csv=True,
+                  bootstrap=0):
+    '''
+    checkpoints: tool.checkpoint.CheckpointManager the full training state is saved to
+                 every epoch, default "checkpoints" next to save_model_path
+    resume: continue after the latest checkpoint instead of starting over
+    overwrite_checkpoints: without resume, delete the checkpoints of an earlier run in
+                           the checkpoint dir instead of refusing to start
+    profile: time the phases of every train / eval step, reported per epoch
+             and kept in profile.json next to save_model_path
+    profile_trace: trace this many train steps with torch.profiler into train_trace.json
+    async_val: validate in a background process (tool.async_validate) while the
+               next epoch trains, the val mAP of an epoch is attached to its
+               checkpoint when it arrives
+    val_device: device of the background validation, default `device`
+    val_threads: torch threads of the background validation, 0 for the torch default
+    save_val_csv: write the val predictions to val_loc.csv every epoch
+    bootstrap: patient bootstrap replicates of the test confidence intervals, 0 for none
+
+    In distributed training `model` is the DistributedDataParallel wrapper;
+    checkpoints, csv files, profiles and tensorboard are written by the main
+    process only, validation and test run on every process and are merged.
+    '''
+    main = utils.is_main_process()
+    model_without_ddp = model.module if isinstance(model, DistributedDataParallel) else model
+    if checkpoints is None and main:
+        checkpoints = CheckpointManager(os.path.join(os.path.dirname(save_model_path), "checkpoints"))
+    scaler = grad_scaler(device, amp)
+    start_epoch = 0
+    state = None
+    if resume and main and checkpoints.latest is not None:
+        state = checkpoints.load()
+    state = utils.broadcast_object(state)
+    if state is not None:
+        model_without_ddp.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        lr_sche.load_state_dict(state["lr_scheduler"])
+        if scaler is not None and "scaler" in state:
+            scaler.load_state_dict(state["scaler"])
+        # one rng state per process
+        set_rng_state(state["rng"][utils.get_rank() % len(state["rng"])])
+        start_epoch = state["epoch"] + 1
+        print(f"resumed from epoch {state['epoch']}")
+    elif not resume and main:
+        if checkpoints.saved:
+            assert overwrite_checkpoints, "found checkpoints of an earlier run in {}, resume or overwrite them.".format(
+                checkpoints.ckpt_dir)
+            print(f"removing the checkpoints of epochs {checkpoints.saved} of an earlier run in {checkpoints.ckpt_dir}")
+        checkpoints.clear()
+
+    out_dir = os.path.dirname(save_model_path)
+    profile = profile and main
+    profile_json = os.path.join(out_dir, "profile.json")
+    if profile and not resume and os.path.exists(profile_json):
+        os.remove(profile_json)
+    profilers = {"train": StepProfiler("train", profile, device, profile_json, profile_trace,
+                                       os.path.join(out_dir, "train_trace.json")),
+                 "val": StepProfiler("val", profile, device, profile_json),
+                 "test": StepProfiler("test", profile, device, profile_json)}
+
+    validator = None
+    if async_val and main:
+        validator = AsyncValidator(model_without_ddp, dataloaders['val'], val_device or device, val_threads,
+                                   save_model_path=save_model_path, amp=amp, save_csv=save_val_csv)
+        # epochs saved before a crash whose validation had not finished
+        for epoch in sorted(e for e in checkpoints.saved if e not in checkpoints.metrics):
+            validator.submit(epoch, checkpoints.load(epoch)["model"])
+
+    def report(epoch, val_mAP):
+        if validator is not None:
+            print(f"Epoch: {epoch}, | val mAP: {val_mAP:.4f} (background)")
+            checkpoints.report(epoch, val_mAP)
         if use_tensorboard:
             writer.add_scalar('Validation mAP',val_mAP,global_step=epoch)
 
+    for epoch in range(start_epoch, num_epochs):
+        train_loader = dataloaders['train']
+        for obj in (train_loader.dataset, train_loader.sampler, train_loader.batch_sampler):
+            if hasattr(obj, 'set_epoch'):
+                obj.set_epoch(epoch)
+        train_one_epoch(epoch, model, train_loader, optimizer, lr_sche, device, writer, augment, amp,
+                        accum_steps, scaler, log_every, profilers['train'])
+        val_mAP = None
+        if not async_val:
+            val_mAP = validate(epoch, model_without_ddp, dataloaders['val'], device, save_model_path, amp,
+                               profilers['val'], writer, save_val_csv)
+
+        rng = utils.all_gather(rng_state())
+        if main:
+            state = {"epoch": epoch, "model": model_without_ddp.state_dict(), "optimizer": optimizer.state_dict(),
+                     "lr_scheduler": lr_sche.state_dict(), "rng": rng}
+            if scaler is not None:
+                state["scaler"] = scaler.state_dict()
+            checkpoints.save(epoch, state, metric=val_mAP)
+
+        if validator is not None:
+            validator.submit(epoch, model_without_ddp.state_dict())
+            for done in validator.poll():
+                report(*done)
+        elif val_mAP is not None:
+            report(epoch, val_mAP)
+
+    best = None
+    if validator is not None:
+        for done in validator.close():
+            report(*done)
+    if main:
+        # the earliest epoch with the best val mAP
+        best_epoch, best_score = checkpoints.best()
+        best = (best_epoch, best_score, checkpoints.load(best_epoch)["model"])
+        checkpoints.close()
+    best_epoch, best_score, best_state = utils.broadcast_object(best)
     print("Training Done!")
     print(f"Best Valid mAP: {best_score:.4f} at epoch {best_epoch}")
-    torch.save(best_stat_dict, save_model_path)
+    model_without_ddp.load_state_dict(best_state)
+    model = model_without_ddp
+    if main:
+        torch.save(model.state_dict(), save_model_path)
 
     print("===============Start Testing===============")
-    model.load_state_dict(best_stat_dict)
-    test_mAP = summary(model, dataloaders['test'], device, save_model_path)
+    metrics = {"fold": fold, "best_epoch": best_epoch, "best_val_mAP": best_score}
+    if amp:
+        # same weights evaluated in fp32, to check mixed precision leaves the mAP unchanged
+        print("fp32 reference:")
+        metrics["test_mAP_fp32"] = summary(model, dataloaders['test'], device, save_model_path)["mAP"]
+        print("mixed precision:")
+    results = summary(model, dataloaders['test'], device, save_model_path, amp, profilers['test'], writer, bootstrap)
     if use_tensorboard:
         writer.close()
+    metrics.update({"test_AP": results['AP']['1'], "test_mAP": results['mAP'], "test_F1": results['F1'],
+                    "test_FROC": results['FROC'], "test_AP75": results['AP75'], "test_AP50_95": results['AP50:95']})
+    for k, (low, high) in results.get("ci", {}).items():
+        metrics.update({f"test_{k}_low": low, f"test_{k}_high": high})
+    return metrics